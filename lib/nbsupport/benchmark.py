@@ -0,0 +1,146 @@
+import json
+import multiprocessing
+import numpy
+import resource
+import time
+
+import nbsupport.simulations
+import nbsupport.util
+
+from collections import OrderedDict
+from contextlib import closing
+from itertools import product
+
+
+####
+#
+# Group-test backends
+#
+# Every backend takes an events matrix and a list of gene index arrays and
+# returns one p-value per group. Imports happen inside the functions, because
+# several backends depend on optional packages.
+#
+
+def discover_backend(events, groups):
+    import discover
+    import pandas
+    matrix = discover.DiscoverMatrix(pandas.DataFrame(events))
+    return [discover.groupwise_discover_test(matrix[group], "impurity") for group in groups]
+
+
+def memo_backend(events, groups, permutations=1000):
+    from nbsupport import memo
+    selected_genes = numpy.unique(numpy.concatenate(groups))
+    return memo.memo_test(events, selected_genes, groups, permutations)
+
+
+def muex_backend(events, groups):
+    from nbsupport import muex
+    return [result.pvalue for result in muex.muex_batch(events, groups)]
+
+
+def megsa_backend(events, groups):
+    from nbsupport import megsa
+    return megsa.megsa_batch(events, groups)
+
+
+def mutex_backend(events, groups):
+    from nbsupport import mutex
+    return mutex.mutex_batch(events, groups)
+
+
+def timex_backend(events, groups):
+    from nbsupport import timex
+    return timex.timex_test(events, groups)
+
+
+def comet_backend(events, groups):
+    from nbsupport import comet
+    return comet.comet_batch(events, groups)[0]
+
+
+BACKENDS = OrderedDict([
+    ("discover", discover_backend),
+    ("memo", memo_backend),
+    ("muex", muex_backend),
+    ("megsa", megsa_backend),
+    ("mutex", mutex_backend),
+    ("timex", timex_backend),
+    ("comet", comet_backend)])
+
+
+####
+#
+# Measurements
+#
+
+def measure(args):
+    backend, events, groups = args
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    try:
+        BACKENDS[backend](events, groups)
+        error = None
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    elapsed = time.time() - start
+
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, peak_after - peak_before, error
+
+
+def measure_in_subprocess(backend, events, groups):
+    # A fresh process per measurement keeps the peak memory of one backend
+    # from hiding that of the next
+    with closing(multiprocessing.Pool(1, maxtasksperchild=1)) as pool:
+        return pool.apply(measure, [(backend, events, groups)])
+
+
+def simulate_groups(gene_marginals, sample_marginals, group_size, num_sets):
+    events = nbsupport.simulations.generate_independent_alterations(gene_marginals, sample_marginals)
+    events, pos_groups, neg_groups = nbsupport.simulations.add_mutex_groups(
+        events, num_sets, minGenes=group_size, maxGenes=group_size)
+    return events, list(neg_groups) + list(pos_groups)
+
+
+def benchmark(reference, output_filename, backends=None, group_sizes=range(3, 7),
+              sample_counts=None, gene_counts=None, num_sets=100):
+    reference = numpy.asarray(reference)
+    backends = BACKENDS.keys() if backends is None else backends
+    sample_counts = [reference.shape[1]] if sample_counts is None else sample_counts
+    gene_counts = [reference.shape[0]] if gene_counts is None else gene_counts
+
+    nbsupport.util.set_random_seed()
+
+    with open(output_filename, "w") as stream:
+        for num_genes, num_samples in product(gene_counts, sample_counts):
+            # Marginals are taken from a random submatrix of the reference
+            rows = numpy.random.choice(reference.shape[0], num_genes, num_genes > reference.shape[0])
+            cols = numpy.random.choice(reference.shape[1], num_samples, num_samples > reference.shape[1])
+            submatrix = reference[rows][:, cols]
+
+            for group_size in group_sizes:
+                events, groups = simulate_groups(
+                    submatrix.sum(1), submatrix.sum(0), group_size, num_sets)
+
+                for backend in backends:
+                    elapsed, peak_memory, error = measure_in_subprocess(backend, events, groups)
+                    record = OrderedDict([
+                        ("backend", backend),
+                        ("num_genes", num_genes),
+                        ("num_samples", num_samples),
+                        ("group_size", group_size),
+                        ("num_groups", len(groups)),
+                        ("seconds", elapsed),
+                        ("groups_per_second", len(groups) / elapsed if error is None else None),
+                        ("peak_memory_increase_kb", peak_memory),
+                        ("error", error)])
+                    stream.write(json.dumps(record) + "\n")
+                    stream.flush()
+
+
+def read_benchmark(filename):
+    import pandas
+    with open(filename) as stream:
+        return pandas.DataFrame([json.loads(line) for line in stream])
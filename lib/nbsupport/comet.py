@@ -1,16 +1,79 @@
+import multiprocessing
 import numpy
+import time
 import comet
 
+from contextlib import closing
+
 from cComet_with_timeout import exact_test, binom_test, precompute_factorials
 
 
-def comet_test(events, timeout=60):
-    table = numpy.histogramdd(
-        events.T, [(0, 0.5, 1)] * events.shape[0])[0].ravel().astype(int)
-    precompute_factorials(events.shape[1])
-    num_tables, p = exact_test(events.shape[0], events.shape[1],
-                               table.tolist(), 1.1, timeout)
-    if p < 0:
+_factorials_num_samples = [None]
+
+
+def ensure_factorials(num_samples):
+    # precompute_factorials fills a global table in the C extension, so it
+    # only has to be redone when the number of samples changes
+    if _factorials_num_samples[0] != num_samples:
+        precompute_factorials(num_samples)
+        _factorials_num_samples[0] = num_samples
+
+
+def comet_tables(events, groups):
+    events = numpy.asarray(events) > 0
+    tables = [None] * len(groups)
+
+    group_sizes = numpy.array([len(group) for group in groups])
+    for k in numpy.unique(group_sizes):
+        selection = numpy.nonzero(group_sizes == k)[0]
+        members = numpy.array([groups[i] for i in selection], dtype=int)
+        codes = (events[members] * (1 << numpy.arange(k - 1, -1, -1))[:, numpy.newaxis]).sum(-2)
+        codes += 2**k * numpy.arange(len(selection))[:, numpy.newaxis]
+        counts = numpy.bincount(codes.ravel(), minlength=len(selection) * 2**k).reshape(-1, 2**k)
+        for j, i in enumerate(selection):
+            tables[i] = counts[j]
+
+    return tables
+
+
+def comet_table_test(table, num_genes, num_samples, timeout=60, deadline=None):
+    ensure_factorials(num_samples)
+    table = numpy.asarray(table).tolist()
+
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
+
+    p = -1
+    if timeout > 0:
+        num_tables, p = exact_test(num_genes, num_samples, table, 1.1, timeout)
+
+    timed_out = p < 0
+    if timed_out:
         # If the CoMEt test timed out, return the binomial approximation
-        p = binom_test(events.shape[0], events.shape[1], table.tolist(), 1.1)
-    return p
+        p = binom_test(num_genes, num_samples, table, 1.1)
+    return p, timed_out
+
+
+def comet_test(events, timeout=60):
+    table = comet_tables(events, [numpy.arange(events.shape[0])])[0]
+    return comet_table_test(table, events.shape[0], events.shape[1], timeout)[0]
+
+
+def _comet_table_test_star(args):
+    return comet_table_test(*args)
+
+
+def comet_batch(events, groups, timeout=60, time_budget=None, workers=None):
+    num_samples = numpy.shape(events)[1]
+    deadline = None if time_budget is None else time.time() + time_budget
+    tasks = [(table, len(group), num_samples, timeout, deadline)
+             for table, group in zip(comet_tables(events, groups), groups)]
+
+    if workers is None or workers == 1:
+        results = map(_comet_table_test_star, tasks)
+    else:
+        with closing(multiprocessing.Pool(workers)) as pool:
+            results = pool.map(_comet_table_test_star, tasks, chunksize=1)
+
+    pvalues, timed_out = zip(*results) if results else ((), ())
+    return numpy.array(pvalues), numpy.array(timed_out, dtype=bool)
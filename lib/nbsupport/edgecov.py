@@ -0,0 +1,73 @@
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+####
+#
+# Edge covariances for de novo gene set identification
+#
+# An edge (a, b) is a pair of genes. Under the background model its
+# coverage statistic sums P_a P_b over samples, and two edges are only
+# correlated if they share a gene. For edges (g, b) and (g, c) the
+# covariance is sum P_g (1 - P_g) P_b P_c, so all pairs of edges meeting at
+# gene g come out of a single weighted product over the neighbours of g.
+#
+
+def incidence_matrix(edges, num_genes):
+    edges = numpy.asarray(edges, dtype=int).reshape(-1, 2)
+    return scipy.sparse.csr_matrix(
+        (numpy.ones(2 * len(edges)),
+         (edges.T.ravel(), numpy.tile(numpy.arange(len(edges)), 2))),
+        shape=(num_genes, len(edges)))
+
+
+def edge_covariance(bg, edges):
+    bg = numpy.asarray(bg)
+    edges = numpy.asarray(edges, dtype=int).reshape(-1, 2)
+    incidence = incidence_matrix(edges, len(bg))
+
+    coverage = bg[edges[:, 0]] * bg[edges[:, 1]]
+    variances = (coverage * (1 - coverage)).sum(1)
+
+    rows = []
+    cols = []
+    values = []
+    for g in numpy.nonzero(numpy.diff(incidence.indptr) > 1)[0]:
+        incident = incidence.indices[incidence.indptr[g]:incidence.indptr[g + 1]]
+        others = numpy.where(edges[incident, 0] == g, edges[incident, 1], edges[incident, 0])
+
+        covariance = (bg[others] * (bg[g] * (1 - bg[g]))).dot(bg[others].T)
+        i, j = numpy.triu_indices(len(incident), 1)
+        rows.append(incident[i])
+        cols.append(incident[j])
+        values.append(covariance[i, j])
+
+    rows = numpy.concatenate(rows + [numpy.zeros(0, dtype=int)])
+    cols = numpy.concatenate(cols + [numpy.zeros(0, dtype=int)])
+    values = numpy.concatenate(values + [numpy.zeros(0)]) / numpy.sqrt(variances[rows] * variances[cols])
+
+    # Edges are standardised, so the result is a correlation matrix
+    diagonal = numpy.arange(len(edges))
+    return scipy.sparse.csr_matrix(
+        (numpy.r_[values, values, numpy.ones(len(edges))],
+         (numpy.r_[rows, cols, diagonal], numpy.r_[cols, rows, diagonal])),
+        shape=(len(edges), len(edges)))
+
+
+def edge_expectations(sigma_x, incidence, k, block_size=1000):
+    # Conditional mean and variance of the edge statistics given the gene
+    # sums k = H x, with sigma_k = H sigma_x H' factorised once instead of
+    # inverted
+    sigma_xk = scipy.sparse.csr_matrix(sigma_x.dot(incidence.T))
+    sigma_k = scipy.sparse.csc_matrix(incidence.dot(sigma_xk))
+    solve = scipy.sparse.linalg.splu(sigma_k).solve
+
+    expectations = sigma_xk.dot(solve(numpy.asarray(k, dtype=float)))
+
+    variances = sigma_x.diagonal().astype(float)
+    for start in xrange(0, len(variances), block_size):
+        block = sigma_xk[start:start + block_size].toarray()
+        variances[start:start + len(block)] -= (block * solve(block.T).T).sum(1)
+
+    return expectations, variances
@@ -0,0 +1,109 @@
+import multiprocessing
+import numpy
+import pandas
+import scipy.sparse
+
+import nbsupport.stats
+
+from contextlib import closing
+
+
+####
+#
+# Gene set membership
+#
+# Gene sets are held as a sparse (gene sets x genes) membership matrix over
+# the genes of an event matrix, and the event rows of each gene (e.g. TP53_mut
+# and TP53_loss) as a sparse (genes x rows) matrix. Their product gives the
+# rows of every gene set in one step.
+#
+
+def event_genes(rownames):
+    genes = numpy.char.partition(numpy.asarray(rownames).astype(str), "_")[:, 0]
+    codes, unique_genes = pandas.factorize(genes, sort=True)
+    rows = scipy.sparse.csr_matrix(
+        (numpy.ones(len(codes), dtype=bool), (codes, numpy.arange(len(codes)))),
+        shape=(len(unique_genes), len(codes)))
+    return pandas.Index(unique_genes), rows
+
+
+def read_gmt(filename, genes):
+    names = []
+    set_genes = []
+
+    with open(filename) as stream:
+        for line in stream:
+            fields = line.split()
+            if len(fields) > 0:
+                names.append(fields[0])
+                set_genes.append(fields[2:])
+
+    # A single hash lookup for all genes of all sets; unknown genes are dropped
+    lengths = numpy.array(map(len, set_genes), dtype=int)
+    codes = pandas.Index(genes).get_indexer(
+        numpy.concatenate([numpy.asarray(x, dtype=object) for x in set_genes] + [numpy.zeros(0, dtype=object)]))
+    set_ids = numpy.repeat(numpy.arange(len(names)), lengths)
+    known = codes >= 0
+
+    membership = scipy.sparse.csr_matrix(
+        (numpy.ones(known.sum()), (set_ids[known], codes[known])), shape=(len(names), len(genes)))
+    membership.sum_duplicates()
+    membership.data[:] = 1
+
+    return pandas.Index(names), membership
+
+
+####
+#
+# Groupwise tests
+#
+
+_events = None
+
+
+def _init_worker(events):
+    global _events
+    _events = events
+
+
+def groupwise_test(rows, method="impurity"):
+    import discover
+
+    mask = numpy.zeros(_events.shape[0], dtype=bool)
+    mask[rows] = True
+    return discover.groupwise_discover_test(_events[mask], method)
+
+
+def _groupwise_test_star(args):
+    return groupwise_test(*args)
+
+
+def test_gene_sets(events, filename, min_size=3, prefixes=None, method="impurity", workers=None, chunksize=10):
+    genes, rows = event_genes(events.rownames)
+    names, membership = read_gmt(filename, genes)
+
+    selected = numpy.diff(membership.indptr) >= min_size
+    if prefixes is not None:
+        selected &= numpy.array([name.startswith(tuple(prefixes)) for name in names], dtype=bool)
+
+    membership = membership[numpy.nonzero(selected)[0]]
+    set_rows = scipy.sparse.csr_matrix(membership.dot(rows))
+    tasks = [(set_rows.indices[set_rows.indptr[i]:set_rows.indptr[i + 1]], method)
+             for i in xrange(set_rows.shape[0])]
+
+    # The event matrix is handed to every worker once rather than with
+    # every task
+    if workers is None or workers == 1:
+        _init_worker(events)
+        pvalues = map(_groupwise_test_star, tasks)
+    else:
+        with closing(multiprocessing.Pool(workers, _init_worker, (events,))) as pool:
+            pvalues = pool.map(_groupwise_test_star, tasks, chunksize)
+
+    pvalues = numpy.asarray(pvalues, dtype=float)
+    return pandas.DataFrame({
+        "num_genes": numpy.diff(membership.indptr),
+        "num_events": numpy.diff(set_rows.indptr),
+        "pvalue": pvalues,
+        "qvalue": nbsupport.stats.fdr(pvalues)},
+        index=names[selected], columns=["num_genes", "num_events", "pvalue", "qvalue"])
@@ -1,19 +1,75 @@
 import discover
+import json
+import numpy
+import os
 import pandas
 
+import nbsupport.pairwise
 
-def save_discover_matrix(path_or_buf, key, matrix):
-    matrix._events.to_hdf(path_or_buf, key + "/events", complevel=9, complib="bzip2")
-    matrix._bg.to_hdf(path_or_buf, key + "/bg", complevel=9, complib="bzip2")
+
+def save_discover_matrix(path_or_buf, key, matrix, format="hdf"):
+    if format == "npy":
+        save_discover_matrix_npy(path_or_buf, key, matrix)
+    elif format == "hdf":
+        matrix._events.to_hdf(path_or_buf, key + "/events", complevel=9, complib="bzip2")
+        matrix._bg.to_hdf(path_or_buf, key + "/bg", complevel=9, complib="bzip2")
+    else:
+        raise ValueError("Invalid format: %s. Legal values are 'hdf' and 'npy'" % format)
 
 
 def load_discover_matrix(path_or_buf, key):
+    if isinstance(path_or_buf, basestring) and os.path.isdir(path_or_buf):
+        return load_discover_matrix_npy(path_or_buf, key)
+
     return discover.DiscoverMatrix(
         pandas.read_hdf(path_or_buf, key + "/events"),
         pandas.read_hdf(path_or_buf, key + "/bg"))
 
 
-def save_pairwise_result(path_or_buf, key, result):
+####
+#
+# Raw .npy storage
+#
+# Events are stored as one uint8 per entry and the background matrix as
+# float32. Loading memory-maps both files and wraps them without copying, so
+# worker processes reading the same matrix share the page cache.
+#
+
+def labels_to_array(labels):
+    labels = numpy.asarray(labels)
+    return labels.astype(unicode) if labels.dtype == object else labels
+
+
+def save_discover_matrix_npy(path, key, matrix):
+    dirname = os.path.join(path, key.strip("/"))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    events = matrix._events
+    numpy.save(os.path.join(dirname, "events.npy"), (events.values > 0).astype(numpy.uint8))
+    numpy.save(os.path.join(dirname, "bg.npy"), matrix._bg.values.astype(numpy.float32))
+    numpy.save(os.path.join(dirname, "rownames.npy"), labels_to_array(events.index))
+    numpy.save(os.path.join(dirname, "colnames.npy"), labels_to_array(events.columns))
+
+
+def load_discover_matrix_npy(path, key):
+    dirname = os.path.join(path, key.strip("/"))
+    rownames = numpy.load(os.path.join(dirname, "rownames.npy"))
+    colnames = numpy.load(os.path.join(dirname, "colnames.npy"))
+
+    events = numpy.load(os.path.join(dirname, "events.npy"), mmap_mode="r")
+    if events.shape[1] != len(colnames):
+        # Older directories hold bit-packed events, which have to be unpacked
+        # into private memory
+        events = numpy.unpackbits(events, axis=1)[:, :len(colnames)]
+    bg = numpy.load(os.path.join(dirname, "bg.npy"), mmap_mode="r")
+
+    return discover.DiscoverMatrix(
+        pandas.DataFrame(events, index=rownames, columns=colnames),
+        pandas.DataFrame(bg, index=rownames, columns=colnames))
+
+
+def save_pairwise_result(path_or_buf, key, result, format="hdf"):
     def f(store):
         store.put(key + "/pvalues", result.pvalues)
         store.put(key + "/qvalues", result.qvalues)
@@ -21,7 +77,11 @@ def save_pairwise_result(path_or_buf, key, result):
         attrs["pi0"] = result.pi0
         attrs["alternative"] = result.alternative
 
-    if isinstance(path_or_buf, pandas.HDFStore):
+    if format == "npy":
+        save_pairwise_result_npy(path_or_buf, key, result)
+    elif format != "hdf":
+        raise ValueError("Invalid format: %s. Legal values are 'hdf' and 'npy'" % format)
+    elif isinstance(path_or_buf, pandas.HDFStore):
         f(path_or_buf)
     else:
         with pandas.HDFStore(path_or_buf, complevel=9, complib="bzip2") as store:
@@ -37,8 +97,44 @@ def load_pairwise_result(path_or_buf, key):
             attrs["pi0"],
             attrs["alternative"])
 
-    if isinstance(path_or_buf, pandas.HDFStore):
+    if isinstance(path_or_buf, basestring) and os.path.isdir(path_or_buf):
+        return load_pairwise_result_npy(path_or_buf, key)
+    elif isinstance(path_or_buf, pandas.HDFStore):
         return f(path_or_buf)
     else:
         with pandas.HDFStore(path_or_buf, "r", complevel=9, complib="bzip2") as store:
             return f(store)
+
+
+def save_pairwise_result_npy(path, key, result):
+    dirname = os.path.join(path, key.strip("/"))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    if not result.pvalues.index.equals(result.pvalues.columns):
+        raise ValueError("Only results with the same genes along both axes can be condensed")
+
+    pvalues, from_lower = nbsupport.pairwise.condense(result.pvalues.values)
+    qvalues, _ = nbsupport.pairwise.condense(result.qvalues.values)
+
+    numpy.save(os.path.join(dirname, "pvalues.npy"), pvalues)
+    numpy.save(os.path.join(dirname, "qvalues.npy"), qvalues)
+    numpy.save(os.path.join(dirname, "from_lower.npy"), numpy.packbits(from_lower))
+    numpy.save(os.path.join(dirname, "genes.npy"), labels_to_array(result.pvalues.index))
+
+    with open(os.path.join(dirname, "attrs.json"), "w") as stream:
+        json.dump({"pi0": result.pi0, "alternative": result.alternative}, stream)
+
+
+def load_pairwise_result_npy(path, key):
+    dirname = os.path.join(path, key.strip("/"))
+    with open(os.path.join(dirname, "attrs.json")) as stream:
+        attrs = json.load(stream)
+
+    return nbsupport.pairwise.CondensedPairwiseDiscoverResult(
+        numpy.load(os.path.join(dirname, "pvalues.npy"), mmap_mode="r"),
+        numpy.load(os.path.join(dirname, "qvalues.npy"), mmap_mode="r"),
+        numpy.load(os.path.join(dirname, "from_lower.npy"), mmap_mode="r"),
+        numpy.load(os.path.join(dirname, "genes.npy")),
+        attrs["pi0"],
+        attrs["alternative"])
@@ -5,20 +5,22 @@ import os
 import urllib
 import zipfile
 
+import numpy
+import scipy.special
 import scipy.stats
 
 import nbsupport.util
 
-import rpy2.robjects.numpy2ri
-rpy2.robjects.numpy2ri.activate()
-
-from rpy2 import robjects
-
 
 MEGSA_URL = "http://dceg.cancer.gov/tools/analysis/megsa/MEGSA_beta.zip"
 
 
 def install(download_dir):
+    import rpy2.robjects.numpy2ri
+    rpy2.robjects.numpy2ri.activate()
+
+    from rpy2 import robjects
+
     local_filename = "%s/MEGSA_beta.zip" % download_dir
     if not os.path.exists(local_filename):
         filename, response = urllib.urlretrieve(MEGSA_URL, local_filename)
@@ -34,3 +36,110 @@ def install(download_dir):
     def megsa(events):
         s = robjects.r.funEstimate(events.T).rx2("S")[0]
         return 0.5 * scipy.stats.chisqprob(s, 1) + 0.5 * int(s == 0)
+
+
+####
+#
+# Native implementation
+#
+# Under the alternative, a fraction pi of the samples carries exactly one
+# mutation in the gene set, in gene k with probability p_k / sum(p). The
+# remaining samples are mutated independently with gene rates p_k. Only the
+# number of unmutated samples, the single hits per gene and the mutation
+# counts within multi-hit samples enter the likelihood.
+#
+
+def megsa_statistics(events, groups):
+    events = numpy.asarray(events) > 0
+    max_size = max(len(group) for group in groups)
+    mask = numpy.zeros((len(groups), max_size), dtype=bool)
+    single_hits = numpy.zeros((len(groups), max_size))
+    multi_hits = numpy.zeros((len(groups), max_size))
+    num_unmutated = numpy.zeros(len(groups))
+    num_multi = numpy.zeros(len(groups))
+
+    for i, group in enumerate(groups):
+        x = events[group]
+        hits = x.sum(0)
+        mask[i, :len(group)] = True
+        single_hits[i, :len(group)] = x[:, hits == 1].sum(1)
+        multi_hits[i, :len(group)] = x[:, hits > 1].sum(1)
+        num_unmutated[i] = (hits == 0).sum()
+        num_multi[i] = (hits > 1).sum()
+
+    return mask, single_hits, multi_hits, num_unmutated, num_multi
+
+
+def megsa_loglik(pi, p, single_hits, multi_hits, num_unmutated, num_multi):
+    log_q = numpy.log1p(-p)
+    background = (scipy.special.xlogy(multi_hits, p) +
+                  scipy.special.xlogy(num_multi[:, numpy.newaxis] - multi_hits, 1 - p)).sum(1)
+    single = (1 - pi[:, numpy.newaxis]) * p * numpy.exp(log_q.sum(1)[:, numpy.newaxis] - log_q) + \
+        pi[:, numpy.newaxis] * p / p.sum(1)[:, numpy.newaxis]
+
+    return (background + scipy.special.xlogy(num_multi + num_unmutated, 1 - pi) +
+            num_unmutated * log_q.sum(1) + scipy.special.xlogy(single_hits, single).sum(1))
+
+
+def megsa_batch(events, groups, max_iter=10000, tol=1e-10):
+    if len(groups) == 0:
+        return numpy.array([])
+
+    num_samples = numpy.shape(events)[1]
+    mask, single_hits, multi_hits, num_unmutated, num_multi = megsa_statistics(events, groups)
+    p0 = (single_hits + multi_hits) / num_samples
+    loglik0 = megsa_loglik(numpy.zeros(len(groups)), p0, single_hits, multi_hits, num_unmutated, num_multi)
+
+    # The statistic is zero whenever the likelihood decreases when moving
+    # away from pi = 0, so only the remaining groups are fitted
+    log_q0 = numpy.log1p(-p0)
+    score = -num_samples + (single_hits * numpy.exp(log_q0 - log_q0.sum(1)[:, numpy.newaxis])).sum(1) / p0.sum(1)
+    fit = numpy.nonzero(score > 0)[0]
+
+    statistic = numpy.zeros(len(groups))
+    if len(fit) > 0:
+        statistic[fit] = numpy.maximum(0, 2 * (megsa_em(
+            p0[fit], mask[fit], single_hits[fit], multi_hits[fit], num_unmutated[fit],
+            num_multi[fit], max_iter, tol) - loglik0[fit]))
+
+    return 0.5 * scipy.stats.chi2.sf(statistic, 1) + 0.5 * (statistic == 0)
+
+
+def megsa_em(p, mask, single_hits, multi_hits, num_unmutated, num_multi, max_iter, tol):
+    num_samples = num_unmutated + num_multi + single_hits.sum(1)
+    pi = 0.5 * single_hits.sum(1) / num_samples
+    loglik = megsa_loglik(pi, p, single_hits, multi_hits, num_unmutated, num_multi)
+
+    for i in xrange(max_iter):
+        # E-step: posterior probability that a single hit is an exclusive one
+        log_q = numpy.log1p(-p)
+        independent = (1 - pi[:, numpy.newaxis]) * numpy.exp(log_q.sum(1)[:, numpy.newaxis] - log_q)
+        exclusive = pi[:, numpy.newaxis] / p.sum(1)[:, numpy.newaxis]
+        w = exclusive / (exclusive + independent)
+
+        exclusive_hits = single_hits * w
+        independent_hits = single_hits - exclusive_hits
+        num_exclusive = exclusive_hits.sum(1)
+
+        # M-step: pi is closed form, p_k solves a quadratic given sum(p)
+        pi = num_exclusive / num_samples
+        a = multi_hits + independent_hits + exclusive_hits
+        b = (num_multi[:, numpy.newaxis] - multi_hits + num_unmutated[:, numpy.newaxis] +
+             independent_hits.sum(1)[:, numpy.newaxis] - independent_hits)
+        c = (num_exclusive / p.sum(1))[:, numpy.newaxis]
+        s = a + b + c
+        p = numpy.where(mask, 2 * a / (s + numpy.sqrt(numpy.maximum(0, s**2 - 4 * a * c))), 0)
+
+        new_loglik = megsa_loglik(pi, p, single_hits, multi_hits, num_unmutated, num_multi)
+        converged = numpy.abs(new_loglik - loglik) < tol
+        loglik = new_loglik
+        if converged.all():
+            break
+
+    return loglik
+
+
+def compare_with_reference(events, groups):
+    native = megsa_batch(events, groups)
+    reference = numpy.array([megsa(events[group]) for group in groups])
+    return native, reference
@@ -1,20 +1,104 @@
+import multiprocessing
 import numpy
 import pandas
 
+import nbsupport.util
 import switching
 
+from contextlib import closing
+
+
+POPCOUNT = numpy.array([bin(i).count("1") for i in xrange(256)], dtype=numpy.uint8)
+
+
+def pack_events(events):
+    return numpy.packbits(numpy.asarray(events) > 0, axis=-1)
+
+
+def group_coverages(packed, members, starts):
+    covered = numpy.bitwise_or.reduceat(packed[..., members, :], starts, axis=-2)
+    return POPCOUNT[covered].sum(-1, dtype=int)
+
+
+def count_higher_coverage(events_selected, groups_memo, coverages, permutations,
+                          block_size=100, stop_after=None, seed=None):
+    if seed is not None:
+        numpy.random.seed(seed)
 
-def memo_test(events, selected_genes, groups, permutations=10000):
-    groups_memo = [pandas.match(group, selected_genes) for group in groups]
-    events_selected = events[selected_genes]
     sampler = switching.EventMatrixSampler(events_selected.astype(int), "gobbi")
-    
-    coverages = numpy.array([events_selected[i].any(0).sum() for i in groups_memo])
+
     higher_coverage = numpy.zeros_like(coverages)
-    
-    for i in xrange(permutations):
-        null_sample = sampler.sample()
-        higher_coverage += (numpy.array([null_sample[i].any(0).sum() for i in groups_memo]) >= coverages).astype(int)
-    
-    return (higher_coverage + 1.0) / (permutations + 1.0)
+    num_permutations = numpy.repeat(permutations, len(groups_memo))
+    active = numpy.arange(len(groups_memo))
+
+    packed = numpy.empty((block_size,) + pack_events(events_selected).shape, dtype=numpy.uint8)
+
+    done = 0
+    while done < permutations and len(active) > 0:
+        block = min(block_size, permutations - done)
+        for i in xrange(block):
+            packed[i] = pack_events(sampler.sample())
+
+        # Only the rows of groups that are still active are OR-reduced
+        active_members = numpy.concatenate([groups_memo[i] for i in active])
+        active_starts = numpy.r_[0, numpy.cumsum([len(groups_memo[i]) for i in active])[:-1]]
+        exceedances = (group_coverages(packed[:block], active_members, active_starts) >=
+                       coverages[active]).cumsum(0)
+
+        if stop_after is None:
+            higher_coverage[active] += exceedances[-1]
+        else:
+            # Besag-Clifford sequential Monte Carlo: a group stops as soon as
+            # it has seen stop_after null coverages at least as high as its own
+            needed = stop_after - higher_coverage[active]
+            stopped = exceedances[-1] >= needed
+            stop_index = (exceedances >= needed).argmax(0)
+
+            higher_coverage[active] += numpy.where(stopped, needed, exceedances[-1])
+            num_permutations[active[stopped]] = done + stop_index[stopped] + 1
+            active = active[~stopped]
+
+        done += block
+
+    return higher_coverage, num_permutations
+
+
+def _count_higher_coverage_star(args):
+    return count_higher_coverage(*args)
+
+
+def memo_test(events, selected_genes, groups, permutations=10000, block_size=100,
+              stop_after=None, workers=None):
+    groups_memo = [pandas.match(group, selected_genes) for group in groups]
+    events_selected = events[selected_genes]
+
+    members = numpy.concatenate(groups_memo)
+    starts = numpy.r_[0, numpy.cumsum([len(group) for group in groups_memo])[:-1]]
+    coverages = group_coverages(pack_events(events_selected), members, starts)
+
+    if workers is None or workers == 1:
+        higher_coverage, num_permutations = count_higher_coverage(
+            events_selected, groups_memo, coverages, permutations, block_size, stop_after)
+    else:
+        if stop_after is not None:
+            raise ValueError("stop_after cannot be combined with multiple workers")
+
+        # The worker seeds come from the global random state, so the merged
+        # counts are reproducible after set_random_seed() for a fixed worker
+        # count, and every call gets its own streams
+        worker_permutations = [len(x) for x in numpy.array_split(numpy.arange(permutations), workers)]
+        seeds = nbsupport.util.worker_random_seeds(workers)
+        tasks = [(events_selected, groups_memo, coverages, n, block_size, None, seed)
+                 for n, seed in zip(worker_permutations, seeds)]
+
+        with closing(multiprocessing.Pool(workers)) as pool:
+            results = pool.map(_count_higher_coverage_star, tasks)
+
+        higher_coverage = numpy.sum([x[0] for x in results], 0)
+        num_permutations = numpy.sum([x[1] for x in results], 0)
+
+    pvalues = (higher_coverage + 1.0) / (permutations + 1.0)
+    stopped = num_permutations < permutations
+    pvalues[stopped] = 1.0 * higher_coverage[stopped] / num_permutations[stopped]
 
+    return pvalues
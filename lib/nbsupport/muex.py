@@ -17,6 +17,9 @@ try:
         result = muex_package.muex(*args)
         return MuexResult(**dict(result.items()))
 
+    def muex_batch(events, groups):
+        return [muex(events[group]) for group in groups]
+
 except:
     import warnings
     warnings.warn("Unable to import the muex R package. "
@@ -26,6 +29,7 @@ except:
                   "generated using the R package.")
     
     import numpy
+    import scipy.special
     import scipy.stats
 
 
@@ -50,71 +54,84 @@ except:
         test_result = muexTestNoErr(Y, theta)
 
         return MuexResult(
-            gamma=theta["gamma"], delta=theta["delta"], alpha=theta["alpha"],
-            beta=theta["beta"], pvalue=test_result["pvalue"], statistic=test_result["statistic"])
+            gamma=float(theta["gamma"]), delta=float(theta["delta"]), alpha=theta["alpha"],
+            beta=theta["beta"], pvalue=float(test_result["pvalue"]),
+            statistic=float(test_result["statistic"]))
+
+
+    def muex_batch(events, groups):
+        events = numpy.asarray(events)
+        results = [None] * len(groups)
+
+        # Groups of equal size are stacked and tested in one go
+        group_sizes = numpy.array([len(group) for group in groups])
+        for size in numpy.unique(group_sizes):
+            selection = numpy.nonzero(group_sizes == size)[0]
+            Y = events[numpy.array([groups[i] for i in selection], dtype=int)]
+
+            theta = muexEstNoErr(Y)
+            theta["alpha"] = 0
+            theta["beta"] = 0
+            test_result = muexTestNoErr(Y, theta)
+
+            for j, i in enumerate(selection):
+                results[i] = MuexResult(
+                    gamma=theta["gamma"][j], delta=theta["delta"][j], alpha=theta["alpha"],
+                    beta=theta["beta"], pvalue=test_result["pvalue"][j],
+                    statistic=test_result["statistic"][j])
+
+        return results
 
 
     def muexEstNoErr(Y):
-        ks = Y.sum(1)
-        m, n = Y.shape
-        gamma = (ks > 0).mean()
-        delta = max(0, 1.0 * Y.sum() / ((n - 1) * m * gamma) - 1.0 / (n - 1))
+        ks = Y.sum(-1)
+        m, n = Y.shape[-2:]
+        gamma = (ks > 0).mean(-1)
+        delta = numpy.maximum(0, 1.0 * Y.sum((-2, -1)) / ((n - 1) * m * gamma) - 1.0 / (n - 1))
         return dict(gamma=gamma, delta=delta)
 
 
     def muexTestNoErr(Y, theta):
-        n = Y.shape[1]
+        n = Y.shape[-1]
         pi_est = F1_i_parest(Y)
-        lik_ind = F1_i_llik(Y, pi_est)
-        lo1 = numpy.apply_along_axis(muexLlikNoErr, 1, Y, theta)
-        lik_g1 = lo1.sum()
+        lo1 = muexLlikNoErr(Y, theta)
         lo2 = F1_i_llik_o(Y, pi_est)
         vuong = F1_vuong(lo1, lo2, coef_no1=2, coef_no2=n)
         return dict(pvalue=vuong["pvalue"], statistic=vuong["statistic"])
 
 
     def F1_i_parest(Y):
-        return Y.mean(0)
+        return Y.mean(-2)
 
 
     def F1_i_llik(Y, pi):
-        kg = Y.sum(0)
-        m = Y.shape[0]
-        return numpy.sum(numpy.log(pi**kg) + numpy.log((1 - pi)**(m - kg)))
-
+        return F1_i_llik_o(Y, pi).sum(-1)
 
-    def muexLlikNoErr(y, theta):
-        k = y.sum()
-        n = len(y)
-        if theta["gamma"] == 0 or theta["delta"] == 0:
-            if k > 0:
-                p = theta["gamma"] * 1.0 * k / n * theta["delta"]**(k - 1) * (1 - theta["delta"])**(n - k)
-            else:
-                p = 1 - theta["gamma"]
-            l = numpy.log(p)
-        else:
-            if k > 0:
-                l = numpy.log(theta["gamma"]) + numpy.log(1.0 * k / n) + (k - 1) * numpy.log(theta["delta"]) + (n - k) * numpy.log(1 - theta["delta"])
-            else:
-                l = numpy.log(1 - theta["gamma"])
-        return l
 
+    def muexLlikNoErr(Y, theta):
+        k = Y.sum(-1)
+        n = Y.shape[-1]
+        gamma = numpy.asarray(theta["gamma"])[..., numpy.newaxis]
+        delta = numpy.asarray(theta["delta"])[..., numpy.newaxis]
 
-    def F1_i_llik_o(Y, pi):
-        return numpy.apply_along_axis(F1_i_llik_y, 1, Y, pi)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            return numpy.where(
+                k > 0,
+                numpy.log(gamma) + numpy.log(1.0 * k / n) +
+                scipy.special.xlogy(k - 1, delta) + scipy.special.xlogy(n - k, 1 - delta),
+                numpy.log(1 - gamma))
 
 
-    def F1_i_llik_y(y, pi):
-        lpi = numpy.log(pi**y)
-        lpi1 = numpy.log((1 - pi)**(1 - y))
-        return numpy.sum(lpi + lpi1)
+    def F1_i_llik_o(Y, pi):
+        pi = pi[..., numpy.newaxis, :]
+        return (scipy.special.xlogy(Y, pi) + scipy.special.xlogy(1 - Y, 1 - pi)).sum(-1)
 
 
     def F1_vuong(lo1, lo2, coef_no1, coef_no2, verbose=False):
         lr_o = lo1 - lo2
-        lr_full = lo1.sum() - lo2.sum()
-        s = numpy.sqrt(numpy.mean(lr_o**2) - (numpy.mean(lr_o))**2)
-        m = len(lr_o)
+        lr_full = lr_o.sum(-1)
+        s = numpy.sqrt(numpy.mean(lr_o**2, -1) - (numpy.mean(lr_o, -1))**2)
+        m = lr_o.shape[-1]
         correct = (numpy.log(m)/2) * (coef_no1 - coef_no2)
         v = (lr_full - correct)/(numpy.sqrt(m) * s)
         if verbose:
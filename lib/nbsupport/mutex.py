@@ -1,4 +1,5 @@
 import numpy
+import scipy.special
 import scipy.stats
 
 
@@ -9,3 +10,69 @@ def mutex(events):
             events[i],
             (col_marginals - events[i] > 0).astype(int), [0, 0.5, 1.0])[0], "less")[1]
         for i in xrange(events.shape[0]))
+
+
+_log_factorial_cache = {}
+
+
+def log_factorials(n):
+    if n not in _log_factorial_cache:
+        _log_factorial_cache[n] = scipy.special.gammaln(numpy.arange(n + 1) + 1.0)
+    return _log_factorial_cache[n]
+
+
+def contingency_tables(events, groups, block_size=1024):
+    events = numpy.asarray(events) > 0
+    group_sizes = numpy.array([len(group) for group in groups])
+    members = numpy.concatenate(groups).astype(int)
+    member_groups = numpy.repeat(numpy.arange(len(groups)), group_sizes)
+
+    group_counts = numpy.zeros((len(groups), events.shape[1]), dtype=int)
+    numpy.add.at(group_counts, member_groups, events[members])
+
+    overlap = numpy.empty(len(members), dtype=int)
+    row_marginals = events[members].sum(1)
+    col_marginals = numpy.empty(len(members), dtype=int)
+
+    for start in xrange(0, len(members), block_size):
+        block = slice(start, start + block_size)
+        x = events[members[block]]
+        others = group_counts[member_groups[block]] - x > 0
+        overlap[block] = (x & others).sum(1)
+        col_marginals[block] = others.sum(1)
+
+    return overlap, row_marginals, col_marginals, member_groups
+
+
+def hypergeom_lower_tail(k, n, K, N):
+    lf = log_factorials(N)
+    lower = numpy.maximum(0, n + K - N)
+    width = max((k - lower).max() + 1, 1)
+    support = lower[:, numpy.newaxis] + numpy.arange(width)
+    valid = support <= k[:, numpy.newaxis]
+    support = numpy.where(valid, support, lower[:, numpy.newaxis])
+
+    n = n[:, numpy.newaxis]
+    K = K[:, numpy.newaxis]
+    log_pmf = (lf[K] - lf[support] - lf[K - support] +
+               lf[N - K] - lf[n - support] - lf[N - K - n + support] -
+               lf[N] + lf[n] + lf[N - n])
+
+    return numpy.minimum(1.0, numpy.where(valid, numpy.exp(log_pmf), 0).sum(1))
+
+
+def mutex_batch(events, groups, block_size=1024):
+    if len(groups) == 0:
+        return numpy.array([])
+
+    num_samples = numpy.shape(events)[1]
+    overlap, row_marginals, col_marginals, member_groups = contingency_tables(
+        events, groups, block_size)
+    pvalues = numpy.empty(len(overlap))
+    for start in xrange(0, len(overlap), block_size):
+        block = slice(start, start + block_size)
+        pvalues[block] = hypergeom_lower_tail(
+            overlap[block], row_marginals[block], col_marginals[block], num_samples)
+
+    starts = numpy.r_[0, numpy.bincount(member_groups, minlength=len(groups)).cumsum()[:-1]]
+    return numpy.maximum.reduceat(pvalues, starts)
@@ -0,0 +1,127 @@
+import numpy
+import pandas
+
+
+####
+#
+# Condensed pairwise matrices
+#
+# A pairwise result holds at most one value per gene pair, in either the
+# upper or the lower triangle. It is stored as a vector over the pairs i < j
+# in the order of numpy.triu_indices, together with a bit per pair that is
+# set when the value came from the lower triangle.
+#
+
+def condensed_index(i, j, n):
+    i, j = numpy.minimum(i, j), numpy.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def square_index(k, n):
+    k = numpy.asarray(k)
+    i = n - 2 - numpy.floor(numpy.sqrt(4 * n * (n - 1) - 8 * k - 7) / 2.0 - 0.5).astype(int)
+    j = k + i + 1 - n * (n - 1) // 2 + (n - i) * (n - i - 1) // 2
+    return i, j
+
+
+def condense(values):
+    values = numpy.asarray(values, dtype=float)
+    if values.ndim != 2 or values.shape[0] != values.shape[1]:
+        raise ValueError("Only square pairwise matrices can be condensed")
+    if not numpy.isnan(numpy.diag(values)).all():
+        raise ValueError("Only pairwise matrices with an empty diagonal can be condensed")
+
+    i, j = numpy.triu_indices(len(values), 1)
+    upper = values[i, j]
+    lower = values[j, i]
+    if (~numpy.isnan(upper) & ~numpy.isnan(lower)).any():
+        raise ValueError("Only pairwise matrices with one value per gene pair can be condensed")
+
+    from_lower = numpy.isnan(upper) & ~numpy.isnan(lower)
+    return numpy.where(from_lower, lower, upper), from_lower
+
+
+def expand(condensed, from_lower):
+    n = int(round((1 + numpy.sqrt(1 + 8 * len(condensed))) / 2))
+    i, j = numpy.triu_indices(n, 1)
+    values = numpy.repeat(numpy.nan, n * n).reshape(n, n)
+    values[numpy.where(from_lower, j, i), numpy.where(from_lower, i, j)] = condensed
+    return values
+
+
+class CondensedPairwiseDiscoverResult(object):
+    def __init__(self, pvalues, qvalues, from_lower, genes, pi0, alternative, block_size=2**20):
+        self.condensed_pvalues = pvalues
+        self.condensed_qvalues = qvalues
+        self.packed_from_lower = from_lower
+        self.genes = pandas.Index(genes)
+        self.pi0 = pi0
+        self.alternative = alternative
+        self.block_size = block_size
+        self._square = {}
+
+    def from_lower(self, k):
+        bits = numpy.unpackbits(self.packed_from_lower[k // 8].reshape(-1, 1), axis=1)
+        return bits[numpy.arange(len(k)), k % 8].astype(bool)
+
+    def oriented_pairs(self, k):
+        i, j = square_index(k, len(self.genes))
+        from_lower = self.from_lower(k)
+        return numpy.where(from_lower, j, i), numpy.where(from_lower, i, j)
+
+    def significant_pairs(self, q_threshold=0.01):
+        # The q-values are scanned block by block, so only the selected pairs
+        # are ever loaded from the memory-mapped vectors
+        with numpy.errstate(invalid="ignore"):
+            selected = [
+                start + numpy.nonzero(self.condensed_qvalues[start:start + self.block_size] <= q_threshold)[0]
+                for start in xrange(0, len(self.condensed_qvalues), self.block_size)]
+        k = numpy.concatenate(selected) if selected else numpy.zeros(0, dtype=int)
+
+        i, j = self.oriented_pairs(k)
+        return pandas.DataFrame({
+            "gene1": self.genes[i],
+            "gene2": self.genes[j],
+            "pvalue": self.condensed_pvalues[k],
+            "qvalue": self.condensed_qvalues[k]}, index=k, columns=["gene1", "gene2", "pvalue", "qvalue"])
+
+    def gene_values(self, gene, values):
+        n = len(self.genes)
+        i = self.genes.get_loc(gene)
+        others = numpy.delete(numpy.arange(n), i)
+        return pandas.Series(values[condensed_index(i, others, n)], index=self.genes[others])
+
+    def gene_pvalues(self, gene):
+        return self.gene_values(gene, self.condensed_pvalues)
+
+    def gene_qvalues(self, gene):
+        return self.gene_values(gene, self.condensed_qvalues)
+
+    @property
+    def index(self):
+        return self.genes
+
+    @property
+    def columns(self):
+        return self.genes
+
+    @property
+    def shape(self):
+        return len(self.genes), len(self.genes)
+
+    def square(self, values):
+        from_lower = numpy.unpackbits(self.packed_from_lower)[:len(values)].astype(bool)
+        return pandas.DataFrame(expand(values, from_lower), index=self.genes, columns=self.genes)
+
+    # The square matrices are only built when they are first asked for
+    @property
+    def pvalues(self):
+        if "pvalues" not in self._square:
+            self._square["pvalues"] = self.square(self.condensed_pvalues)
+        return self._square["pvalues"]
+
+    @property
+    def qvalues(self):
+        if "qvalues" not in self._square:
+            self._square["qvalues"] = self.square(self.condensed_qvalues)
+        return self._square["qvalues"]
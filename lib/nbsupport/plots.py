@@ -98,7 +98,11 @@ def event_plot(events, rowHeight=100):
     plt.xlim(0, x.ix[genes].any(0).sum())
 
 
-def plot_average_roc_curves(pvalues, labels, method_params):
+def method_pvalues(pvalues, method):
+    return numpy.array([numpy.asarray(replicate[method], dtype=float) for replicate in pvalues])
+
+
+def plot_average_roc_curves(pvalues, labels, method_params, confidence=None):
     with use_custom_style({"font.size": 12,
                            "legend.fontsize": 12,
                            "lines.linewidth": 2}):
@@ -107,13 +111,16 @@ def plot_average_roc_curves(pvalues, labels, method_params):
         ax = plt.gca()
 
         for method, colour, label in method_params:
-            coords = [
-                nbsupport.roc.pvalue_roc_curve(labels, numpy.array(pvalues[i][method]))[:2]
-                for i in xrange(len(pvalues))]
+            replicate_pvalues = method_pvalues(pvalues, method)
+            summary = nbsupport.roc.roc_summary(labels, replicate_pvalues)
+            plt.plot(summary.fpr, summary.tpr, label=label, c=colour)
 
-            fpr, tpr = nbsupport.roc.average_roc_curves(coords)
-            plt.plot(fpr, tpr, label=label, c=colour)
-            print "%s:" % method, nbsupport.roc.auc(fpr, tpr)
+            if confidence is None:
+                print "%s:" % method, summary.auc
+            else:
+                bands = nbsupport.roc.roc_confidence_bands(labels, replicate_pvalues, confidence=confidence)
+                plt.fill_between(bands.fpr, bands.tpr[0], bands.tpr[1], color=colour, alpha=0.2, lw=0)
+                print "%s:" % method, summary.auc, "(%g-%g)" % bands.auc
 
         ax.legend(frameon=False, ncol=1, loc="lower right")
 
@@ -121,7 +128,7 @@ def plot_average_roc_curves(pvalues, labels, method_params):
         ax.set_ylabel("True positive rate")
 
 
-def plot_average_calibration_curves(pvalues, labels, method_params):
+def plot_average_calibration_curves(pvalues, labels, method_params, confidence=None):
     with use_custom_style({"font.size": 12,
                            "legend.fontsize": 12,
                            "lines.linewidth": 2}):
@@ -130,12 +137,13 @@ def plot_average_calibration_curves(pvalues, labels, method_params):
         ax = plt.gca()
 
         for method, colour, label in method_params:
-            fprs_tprs_thresholds = [
-                nbsupport.roc.pvalue_roc_curve(labels, numpy.array(pvalues[i][method]))
-                for i in xrange(len(pvalues))]
+            replicate_pvalues = method_pvalues(pvalues, method)
+            summary = nbsupport.roc.roc_summary(labels, replicate_pvalues)
+            plt.plot(summary.thresholds, summary.calibration, label=label, c=colour)
 
-            threshold, fpr = nbsupport.roc.average_calibration_curves(fprs_tprs_thresholds)
-            plt.plot(threshold, fpr, label=label, c=colour)
+            if confidence is not None:
+                bands = nbsupport.roc.roc_confidence_bands(labels, replicate_pvalues, confidence=confidence)
+                plt.fill_between(bands.thresholds, bands.calibration[0], bands.calibration[1], color=colour, alpha=0.2, lw=0)
 
         ax.legend(frameon=False, ncol=1, loc="lower right")
 
@@ -143,7 +151,7 @@ def plot_average_calibration_curves(pvalues, labels, method_params):
         ax.set_ylabel("False positive rate")
 
 
-def plot_average_sensitivity_curves(pvalues, labels, method_params):
+def plot_average_sensitivity_curves(pvalues, labels, method_params, confidence=None):
     with use_custom_style({"font.size": 12,
                            "legend.fontsize": 12,
                            "lines.linewidth": 2}):
@@ -152,12 +160,13 @@ def plot_average_sensitivity_curves(pvalues, labels, method_params):
         ax = plt.gca()
 
         for method, colour, label in method_params:
-            fprs_tprs_thresholds = [
-                nbsupport.roc.pvalue_roc_curve(labels, numpy.array(pvalues[i][method]))
-                for i in xrange(len(pvalues))]
+            replicate_pvalues = method_pvalues(pvalues, method)
+            summary = nbsupport.roc.roc_summary(labels, replicate_pvalues)
+            plt.plot(summary.thresholds, summary.sensitivity, label=label, c=colour)
 
-            threshold, tpr = nbsupport.roc.average_sensitivity_curves(fprs_tprs_thresholds)
-            plt.plot(threshold, tpr, label=label, c=colour)
+            if confidence is not None:
+                bands = nbsupport.roc.roc_confidence_bands(labels, replicate_pvalues, confidence=confidence)
+                plt.fill_between(bands.thresholds, bands.sensitivity[0], bands.sensitivity[1], color=colour, alpha=0.2, lw=0)
 
         ax.legend(frameon=False, ncol=1, loc="lower right")
 
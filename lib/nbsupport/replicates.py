@@ -0,0 +1,73 @@
+import itertools
+import multiprocessing
+import numpy
+import pandas
+import random
+
+import nbsupport.util
+
+from contextlib import closing
+
+
+COMPLETED_KEY = "/completed"
+
+
+def replicate_key(replicate, method):
+    return "/replicates/r%06d/%s" % (replicate, method)
+
+
+def completed_replicates(store):
+    if COMPLETED_KEY in store:
+        return set(store.get(COMPLETED_KEY).values)
+    else:
+        return set()
+
+
+def run_replicate(args):
+    func, replicate, seed = args
+    random.seed(seed)
+    numpy.random.seed(seed)
+    return replicate, func(replicate)
+
+
+def store_replicates(path, results):
+    with pandas.HDFStore(path, complevel=9, complib="blosc") as store:
+        for replicate, pvalues in results:
+            for method, p in pvalues.iteritems():
+                store.put(replicate_key(replicate, method), pandas.Series(numpy.asarray(p, dtype=float)))
+
+            # A replicate only counts as completed once all its methods are
+            # written, so an interrupted write is redone on resume
+            store.append(COMPLETED_KEY, pandas.Series([replicate]))
+            store.flush()
+
+
+def run_replicates(path, func, numReplicates, workers=None):
+    # Replicate i is always seeded with the i-th seed derived from
+    # NUMPY_RANDOM_SEED, whichever worker runs it and whenever it runs
+    seeds = nbsupport.util.derived_random_seeds(numReplicates)
+
+    with pandas.HDFStore(path, complevel=9, complib="blosc") as store:
+        completed = completed_replicates(store)
+    tasks = [(func, i, seeds[i]) for i in xrange(numReplicates) if i not in completed]
+
+    if workers is None or workers == 1:
+        store_replicates(path, itertools.imap(run_replicate, tasks))
+    else:
+        # The pool is created before the store is opened, so that the
+        # workers do not inherit its file handle
+        with closing(multiprocessing.Pool(workers)) as pool:
+            store_replicates(path, pool.imap_unordered(run_replicate, tasks))
+
+
+def load_replicates(path):
+    with pandas.HDFStore(path, "r") as store:
+        replicates = sorted(completed_replicates(store))
+        methods = {}
+        for key in store.keys():
+            if key.startswith("/replicates/"):
+                replicate, method = key.split("/")[2:]
+                methods.setdefault(int(replicate[1:]), []).append(method)
+
+        return [{method: store.get(replicate_key(i, method)).values for method in methods[i]}
+                for i in replicates]
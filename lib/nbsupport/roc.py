@@ -1,14 +1,18 @@
 import numpy
 
+from collections import namedtuple
 from scipy.interpolate import interp1d
 
 
+THRESHOLDS = numpy.unique(numpy.r_[0, numpy.logspace(-70, -1, 1000),
+                                   numpy.linspace(0.1, 1, 1000), 1.1])
+
+
 def pvalue_roc_curve(labels, pvalues):
     sorted_pvalues = numpy.sort(pvalues)
     sorted_labels = labels[pvalues.argsort()]
 
-    unique_thresholds = numpy.unique(numpy.r_[0, numpy.logspace(-70, -1, 1000),
-                                              numpy.linspace(0.1, 1, 1000), 1.1])
+    unique_thresholds = THRESHOLDS
 
     indices = sorted_pvalues.searchsorted(unique_thresholds)
     tp = numpy.append(0, sorted_labels.cumsum())[indices]
@@ -99,3 +103,124 @@ def average_sensitivity_curves(coords):
     y = numpy.mean([f(x) for f in funcs], 0)
 
     return x, y
+
+
+####
+#
+# Batched curves
+#
+# The p-values of all replicates of a method are given as a (replicates x
+# tests) array and evaluated at the shared THRESHOLDS grid, so per-replicate
+# curves line up column by column.
+#
+
+RocSummary = namedtuple("RocSummary", "fpr tpr auc thresholds calibration sensitivity aucs")
+RocBands = namedtuple("RocBands", "fpr tpr thresholds calibration sensitivity auc")
+
+
+def pvalue_roc_curves(labels, pvalues, thresholds=THRESHOLDS):
+    pvalues = numpy.atleast_2d(pvalues)
+    labels = numpy.broadcast_to(labels, pvalues.shape).astype(bool)
+
+    # A p-value is counted at every threshold above it, so a single
+    # searchsorted into the grid and a running sum replace the sorts
+    first = numpy.searchsorted(thresholds, pvalues, "right")
+    offsets = (len(thresholds) + 1) * numpy.arange(len(pvalues))[:, numpy.newaxis]
+
+    def counts(selected):
+        bins = numpy.bincount((first + offsets)[selected], minlength=offsets[-1, 0] + len(thresholds) + 1)
+        return bins.reshape(len(pvalues), -1)[:, :-1].cumsum(1)
+
+    tp = counts(labels)
+    fp = counts(~labels)
+    tpr = 1.0 * tp / labels.sum(1)[:, numpy.newaxis]
+    fpr = 1.0 * fp / (~labels).sum(1)[:, numpy.newaxis]
+
+    return fpr, tpr, thresholds
+
+
+def interpolate_roc_curves(fprs, tprs, grid=None):
+    if grid is None:
+        grid = numpy.unique(fprs)
+
+    # Within a run of equal false positive rates, only the last (largest)
+    # true positive rate is kept
+    keep = numpy.c_[fprs[:, 1:] != fprs[:, :-1], numpy.ones(len(fprs), dtype=bool)]
+    curves = numpy.array([numpy.interp(grid, fpr[k], tpr[k]) for fpr, tpr, k in zip(fprs, tprs, keep)])
+
+    return grid, curves
+
+
+def significance_curves(rates, thresholds):
+    # Rates at the significance levels up to 1. Tests are counted for p < t,
+    # so p-values of exactly 1 are only covered by ending every curve at
+    # (1, 1), as average_calibration_curves and average_sensitivity_curves do
+    alpha = thresholds <= 1
+    curves = rates[:, alpha].copy()
+    curves[:, thresholds[alpha] == 1] = 1
+    return thresholds[alpha], curves
+
+
+def roc_summary(labels, pvalues):
+    fprs, tprs, thresholds = pvalue_roc_curves(labels, pvalues)
+    fpr, curves = interpolate_roc_curves(fprs, tprs)
+    tpr = curves.mean(0)
+
+    if tpr[0] > 0:
+        tpr = numpy.r_[0, tpr]
+        fpr = numpy.r_[0, fpr]
+
+    alpha, calibration = significance_curves(fprs, thresholds)
+    alpha, sensitivity = significance_curves(tprs, thresholds)
+    return RocSummary(fpr, tpr, auc(fpr, tpr), alpha, calibration.mean(0),
+                      sensitivity.mean(0), numpy.trapz(tprs, fprs, axis=1))
+
+
+####
+#
+# Bootstrap confidence bands
+#
+# Replicates are resampled with replacement. A resample only changes how
+# often each replicate enters the mean, so every batch of draws becomes a
+# (draws x replicates) count matrix times the per-replicate curve matrix.
+#
+
+def bootstrap_means(curves, num_bootstraps=1000, batch_size=100):
+    num_replicates = len(curves)
+    means = numpy.empty((num_bootstraps, curves.shape[1]))
+
+    for start in xrange(0, num_bootstraps, batch_size):
+        n = min(batch_size, num_bootstraps - start)
+        draws = numpy.random.randint(num_replicates, size=(n, num_replicates))
+        draws += num_replicates * numpy.arange(n)[:, numpy.newaxis]
+        counts = numpy.bincount(draws.ravel(), minlength=n * num_replicates).reshape(n, num_replicates)
+        means[start:start + n] = counts.dot(curves) / float(num_replicates)
+
+    return means
+
+
+def percentile_band(samples, confidence=0.95):
+    if not 0 < confidence < 1:
+        raise ValueError("Invalid confidence: %s. Legal values are between 0 and 1" % confidence)
+
+    tail = 50.0 * (1 - confidence)
+    lower, upper = numpy.percentile(samples, [tail, 100 - tail], axis=0)
+    return lower, upper
+
+
+def roc_confidence_bands(labels, pvalues, num_bootstraps=1000, confidence=0.95, batch_size=100):
+    fprs, tprs, thresholds = pvalue_roc_curves(labels, pvalues)
+    fpr, curves = interpolate_roc_curves(fprs, tprs)
+    alpha, calibration = significance_curves(fprs, thresholds)
+    alpha, sensitivity = significance_curves(tprs, thresholds)
+
+    # The three curve families are resampled with the same draws
+    means = bootstrap_means(
+        numpy.hstack([curves, calibration, sensitivity]), num_bootstraps, batch_size)
+    roc_means, calibration_means, sensitivity_means = numpy.split(
+        means, [len(fpr), len(fpr) + len(alpha)], axis=1)
+
+    return RocBands(fpr, percentile_band(roc_means, confidence), alpha,
+                    percentile_band(calibration_means, confidence),
+                    percentile_band(sensitivity_means, confidence),
+                    percentile_band(numpy.trapz(roc_means, fpr, axis=1), confidence))
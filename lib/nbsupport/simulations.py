@@ -1,8 +1,8 @@
 import networkx
 import numpy
+import scipy.sparse
 import scipy.stats
 
-from itertools import combinations
 from statsmodels.regression import quantile_regression
 
 
@@ -18,6 +18,120 @@ def generate_independent_alterations(geneMarginals, sampleMarginals):
         graph, [n for n in graph if graph.node[n]["bipartite"] == 0]).toarray()
 
 
+def resolve_duplicate_edges(genes, samples, numSamples, numEdges, maxIter=1000):
+    # Swap the sample end of every duplicate edge with that of a random edge
+    # in the same replicate, as long as the swap creates no new duplicate;
+    # swaps preserve both marginals
+    for i in xrange(maxIter):
+        keys = genes * numSamples + samples
+        order = keys.argsort()
+        sortedKeys = keys[order]
+        duplicates = order[1:][sortedKeys[1:] == sortedKeys[:-1]]
+        if len(duplicates) == 0:
+            break
+
+        partners = duplicates // numEdges * numEdges + numpy.random.randint(numEdges, size=len(duplicates))
+        newKeys = numpy.concatenate([genes[duplicates] * numSamples + samples[partners],
+                                     genes[partners] * numSamples + samples[duplicates]])
+        position = numpy.minimum(sortedKeys.searchsorted(newKeys), len(keys) - 1)
+        exists = (sortedKeys[position] == newKeys).reshape(2, -1).any(0)
+
+        # Every edge takes part in at most one swap per round
+        edges, counts = numpy.unique(numpy.r_[duplicates, partners], return_counts=True)
+        shared = numpy.in1d(duplicates, edges[counts > 1]) | numpy.in1d(partners, edges[counts > 1])
+        accept = ~exists & ~shared
+
+        duplicates = duplicates[accept]
+        partners = partners[accept]
+        samples[duplicates], samples[partners] = samples[partners], samples[duplicates]
+    else:
+        # Collapsing the remaining duplicates would silently reduce both marginals
+        raise RuntimeError("Duplicate edges remain after %d iterations; the marginals may not "
+                           "be realisable without duplicates" % maxIter)
+
+    return samples
+
+
+def generate_independent_alterations_sparse(geneMarginals, sampleMarginals, numReplicates=None,
+                                            resolveDuplicates=False):
+    geneMarginals = numpy.asarray(geneMarginals, dtype=int)
+    sampleMarginals = numpy.asarray(sampleMarginals, dtype=int)
+    if geneMarginals.sum() != sampleMarginals.sum():
+        raise ValueError("Gene and sample marginals do not sum to the same number of alterations")
+
+    numGenes = len(geneMarginals)
+    numSamples = len(sampleMarginals)
+    numEdges = geneMarginals.sum()
+    replicates = 1 if numReplicates is None else numReplicates
+
+    # Pair the gene stubs with a random permutation of the sample stubs, one
+    # row of permutations per replicate; genes of replicate r are offset by r
+    # times the number of genes
+    geneStubs = numpy.repeat(numpy.arange(numGenes), geneMarginals)
+    sampleStubs = numpy.repeat(numpy.arange(numSamples), sampleMarginals)
+    genes = (geneStubs + numGenes * numpy.arange(replicates)[:, numpy.newaxis]).ravel()
+    samples = sampleStubs[numpy.random.random((replicates, numEdges)).argsort(1)].ravel()
+
+    if resolveDuplicates:
+        samples = resolve_duplicate_edges(genes, samples, numSamples, numEdges)
+
+    events = scipy.sparse.csr_matrix(
+        (numpy.ones(len(genes), dtype=numpy.int8), (genes, samples)),
+        shape=(replicates * numGenes, numSamples))
+    events.sum_duplicates()
+    events.data[:] = 1
+
+    if numReplicates is None:
+        return events
+    else:
+        return [events[i * numGenes:(i + 1) * numGenes] for i in xrange(replicates)]
+
+
+####
+#
+# Pairwise statistics
+#
+
+def pairwise_statistics(events, genes, block_size=1000):
+    x = (numpy.asarray(events)[genes] > 0).astype(numpy.float32)
+    numSamples = x.shape[1]
+    marginals = x.sum(1)
+
+    # Pairs are stored in the order of itertools.combinations(genes, 2)
+    numGenes = len(genes)
+    overlap = numpy.empty(numGenes * (numGenes - 1) // 2)
+    first = numpy.empty(len(overlap))
+    second = numpy.empty(len(overlap))
+
+    offset = 0
+    for start in xrange(0, numGenes, block_size):
+        rows = numpy.arange(start, min(start + block_size, numGenes))
+        upper = numpy.arange(numGenes) > rows[:, numpy.newaxis]
+        size = upper.sum()
+
+        overlap[offset:offset + size] = x[rows].dot(x.T)[upper]
+        first[offset:offset + size] = numpy.broadcast_to(marginals[rows, numpy.newaxis], upper.shape)[upper]
+        second[offset:offset + size] = numpy.broadcast_to(marginals, upper.shape)[upper]
+        offset += size
+
+    coverage = first + second - overlap
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.rec.fromarrays(
+            [overlap, coverage, coverage / numSamples, overlap / coverage,
+             numpy.minimum(first, second) / numpy.maximum(first, second)],
+            names=["overlap", "coverage", "coverage_fraction", "impurity", "balance"])
+
+
+def top_k_mask(keys, k):
+    # Marks the k[r] largest keys of every row r; keys of -inf mark
+    # excluded entries and are never selected
+    sortedKeys = -numpy.sort(-keys, 1)
+    thresholds = numpy.where(
+        k > 0, sortedKeys[numpy.arange(len(keys)), numpy.maximum(k, 1) - 1], numpy.inf)
+    return (keys >= thresholds[:, numpy.newaxis]) & numpy.isfinite(keys)
+
+
 ####
 #
 # Simulate mutual exclusivities
@@ -47,59 +161,109 @@ def generate_mutex(events, genes, qreg):
     return i, x
 
 
+def generate_mutex_batch(events, genes, qreg, numMutex):
+    events = numpy.asarray(events)
+    geneMarginals = events.sum(1)
+    sampleMarginals = events.sum(0)
+
+    # 1. Pick random genes
+    i = numpy.random.choice(genes, numMutex)
+    altered = events[i] == 1
+
+    # 2. Sample the coverages of the second genes
+    eligible = ~altered & (sampleMarginals > 0)
+    p = numpy.minimum(numpy.random.choice(geneMarginals[genes], numMutex), eligible.sum(1))
+
+    # 3. Generate the second gene vectors: weighted sampling without
+    # replacement of p samples among those where the first gene is unaltered,
+    # using exponential keys (Efraimidis and Spirakis)
+    with numpy.errstate(divide="ignore"):
+        keys = numpy.where(
+            ~eligible, -numpy.inf,
+            numpy.log(numpy.random.random(altered.shape)) / sampleMarginals)
+    x = top_k_mask(keys, p)
+
+    cov = 1.0 * (geneMarginals[i] + p) / events.shape[1]
+
+    # 4. Sample the impurity parameters
+    impurity = numpy.random.random(numMutex) * qreg.predict(cov[:, numpy.newaxis])
+
+    prob = numpy.clip(impurity / (1.0 * geneMarginals[i] / (geneMarginals[i] + p)), 0, 1)
+    x |= altered & (numpy.random.random(altered.shape) < prob[:, numpy.newaxis])
+
+    return i, x.astype(events.dtype)
+
+
 def add_mutual_exclusivities(events, numMutex=500):
     events = numpy.asarray(events)
     
     genesMinFreq50 = numpy.where(events.sum(1) >= 50)[0]
-    from discover.stats import mutexParams
-
-    mutexStats = numpy.rec.fromrecords(
-        [mutexParams(events[[i, j]])
-         for i, j
-         in combinations(genesMinFreq50, 2)],
-        names=["coverage", "impurity", "balance"])
+    mutexStats = pairwise_statistics(events, genesMinFreq50)
 
     mutexQReg = quantile_regression.QuantReg(
-        mutexStats["impurity"], mutexStats["coverage"]).fit(0.01)
-
-    mutexGeneIndexes = []
-    mutexGeneEvents = []
-
-    for i in xrange(numMutex):
-        j, e = generate_mutex(events, genesMinFreq50, mutexQReg)
-        mutexGeneIndexes.append((j, events.shape[0] + i))
-        mutexGeneEvents.append(e)
+        mutexStats["impurity"], mutexStats["coverage_fraction"]).fit(0.01)
 
-    eventsWithMutex = numpy.row_stack([events, mutexGeneEvents])
+    eventsWithMutex = numpy.empty((events.shape[0] + numMutex, events.shape[1]), dtype=events.dtype)
+    eventsWithMutex[:events.shape[0]] = events
+    genes, eventsWithMutex[events.shape[0]:] = generate_mutex_batch(
+        events, genesMinFreq50, mutexQReg, numMutex)
 
-    return eventsWithMutex, numpy.array(mutexGeneIndexes)
+    return eventsWithMutex, numpy.column_stack([genes, events.shape[0] + numpy.arange(numMutex)])
 
 
 def generate_mutex_group(filtered_gene_counts, sample_marginals, coverage=0.5, impurity=0.05):
     num_samples = len(sample_marginals)
     num_covered_samples = int(coverage * num_samples)
 
-    gene_coverages = []
-    while sum(gene_coverages) < num_covered_samples:
-        gene_coverages.append(numpy.random.choice(filtered_gene_counts))
+    # Draw enough gene coverages at once and keep them up to the first one
+    # that brings the total to the requested coverage
+    max_genes = num_covered_samples // max(1, numpy.min(filtered_gene_counts)) + 1
+    gene_coverages = numpy.random.choice(filtered_gene_counts, max_genes)
+    num_genes = max(1, numpy.cumsum(gene_coverages).searchsorted(num_covered_samples) + 1)
+    gene_coverages = gene_coverages[:num_genes]
 
     p = 1.0 * sample_marginals / sample_marginals.sum()
     altered_samples = numpy.random.choice(num_samples, num_covered_samples, False, p)
 
-    num_genes = len(gene_coverages)
     events = numpy.zeros((num_genes, num_samples))
 
     gene_weights = numpy.array(gene_coverages, dtype=float)
-    for sample in altered_samples:
-        gene = numpy.random.choice(num_genes, p=gene_weights/gene_weights.sum())
-        events[gene, sample] = 1
-
-    current_impurity = 1.0 * (events.sum(0) > 1).sum() / events.any(0).sum()
-    while current_impurity < impurity:
-        i = numpy.random.randint(events.shape[0])
-        j = numpy.random.choice(altered_samples, p=p[altered_samples] / p[altered_samples].sum())
+    sample_genes = numpy.random.choice(num_genes, len(altered_samples), p=gene_weights / gene_weights.sum())
+    events[sample_genes, altered_samples] = 1
+
+    if num_genes < 2 or num_covered_samples == 0:
+        return events
+
+    # Every covered sample starts with a single hit, so the impurity only
+    # depends on how many covered samples have received a second gene
+    num_impure = int(numpy.ceil(impurity * num_covered_samples))
+    if num_impure > 0 and 1.0 * (num_impure - 1) / num_covered_samples >= impurity:
+        num_impure -= 1
+
+    sample_gene = numpy.zeros(num_samples, dtype=int)
+    sample_gene[altered_samples] = sample_genes
+    impure = numpy.zeros(num_samples, dtype=bool)
+    q = p[altered_samples] / p[altered_samples].sum()
+
+    while impure.sum() < num_impure:
+        batch_size = 2 * (num_impure - impure.sum())
+        i = numpy.random.randint(num_genes, size=batch_size)
+        j = numpy.random.choice(altered_samples, batch_size, p=q)
+
+        # A hit only makes a sample impure the first time it lands on a gene
+        # other than the one that covers it
+        hit = i != sample_gene[j]
+        first = numpy.zeros(batch_size, dtype=bool)
+        candidates = numpy.nonzero(hit & ~impure[j])[0]
+        first[candidates[numpy.unique(j[candidates], return_index=True)[1]]] = True
+
+        missing = num_impure - impure.sum()
+        if first.sum() >= missing:
+            i = i[:numpy.nonzero(first)[0][missing - 1] + 1]
+            j = j[:len(i)]
+
         events[i, j] = 1
-        current_impurity = 1.0 * (events.sum(0) > 1).sum() / events.any(0).sum()
+        impure[j[first[:len(j)]]] = True
 
     return events
 
@@ -162,27 +326,42 @@ def generate_cooc(events, genes, qreg):
     return i, x
 
 
+def generate_cooc_batch(events, genes, qreg, numCooc):
+    events = numpy.asarray(events)
+    geneMarginals = events.sum(1)
+
+    i = numpy.random.choice(genes, numCooc)
+    altered = events[i] == 1
+
+    k = numpy.minimum(numpy.random.geometric(0.2, numCooc), (~altered).sum(1))
+    coverage = geneMarginals[i] + k
+
+    minOverlap = qreg.predict(coverage[:, numpy.newaxis])
+    overlap = minOverlap + numpy.random.beta(5, 1, numCooc) * (geneMarginals[i] - minOverlap)
+    overlap = numpy.clip(overlap.astype(int), 0, geneMarginals[i])
+
+    # Uniform sampling without replacement within the altered and the
+    # unaltered samples of the first gene
+    keys = numpy.random.random(altered.shape)
+    x = top_k_mask(numpy.where(altered, keys, -numpy.inf), overlap) | \
+        top_k_mask(numpy.where(altered, -numpy.inf, keys), k)
+
+    return i, x.astype(events.dtype)
+
+
 def add_cooccurrences(events, numCooc=500):
     events = numpy.asarray(events)
 
     genesMinFreq50 = numpy.where(events.sum(1) >= 50)[0]
 
-    coocStats = numpy.rec.fromrecords(
-        [[events[[i, j]].all(0).sum(), events[[i, j]].any(0).sum()]
-         for i, j in combinations(genesMinFreq50, 2)],
-        names=["overlap", "coverage"])
+    coocStats = pairwise_statistics(events, genesMinFreq50)
 
     coocQReg = quantile_regression.QuantReg(
         coocStats["overlap"], coocStats["coverage"]).fit(0.99)
 
-    coocGeneIndexes = []
-    coocGeneEvents = []
-
-    for i in xrange(numCooc):
-        j, e = generate_cooc(events, genesMinFreq50, coocQReg)
-        coocGeneIndexes.append((j, events.shape[0] + i))
-        coocGeneEvents.append(e)
-
-    eventsWithCooc = numpy.row_stack([events, coocGeneEvents])
+    eventsWithCooc = numpy.empty((events.shape[0] + numCooc, events.shape[1]), dtype=events.dtype)
+    eventsWithCooc[:events.shape[0]] = events
+    genes, eventsWithCooc[events.shape[0]:] = generate_cooc_batch(
+        events, genesMinFreq50, coocQReg, numCooc)
 
-    return eventsWithCooc, numpy.array(coocGeneIndexes)
+    return eventsWithCooc, numpy.column_stack([genes, events.shape[0] + numpy.arange(numCooc)])
@@ -2,26 +2,91 @@ import numpy
 
 
 def cummin(x):
-    result = numpy.empty(len(x))
-    result[0] = x[0]
-    for i in xrange(1, len(x)):
-        result[i] = min(result[i - 1], x[i])
+    return numpy.minimum.accumulate(x)
 
-    return result
 
-
-def fdr(p, pi0=1.0):
+def check_pi0(pi0):
     if not 0 <= pi0 <= 1:
         raise ValueError("Invalid value for pi0: %s. Legal values are between 0 and 1" % pi0)
 
-    nna = ~numpy.isnan(p)
-    q = numpy.repeat(numpy.nan, len(p))
-    p = p[nna]
 
-    i = numpy.arange(len(p), 0, -1)
-    o = numpy.argsort(p)[::-1]
-    ro = numpy.argsort(o)
+def fdr(p, pi0=1.0):
+    check_pi0(pi0)
+
+    # Masked entries are treated like missing p-values; the result has the
+    # shape, and for masked input the mask, of p
+    mask = numpy.ma.getmaskarray(p)
+    flat = numpy.ma.getdata(p).ravel()
+    nna = ~numpy.isnan(flat) & ~mask.ravel()
+    q = numpy.repeat(numpy.nan, flat.size)
+
+    valid = flat[nna]
+    o = numpy.argsort(valid)
+    ranked = float(pi0) * len(valid) / numpy.arange(1, len(valid) + 1) * valid[o]
+
+    q_valid = numpy.empty(len(valid))
+    q_valid[o] = numpy.minimum(1, cummin(ranked[::-1])[::-1])
+    q[nna] = q_valid
+
+    q = q.reshape(numpy.shape(p))
+    return numpy.ma.masked_array(q, mask) if numpy.ma.isMaskedArray(p) else q
+
+
+def blocks(p, block_size):
+    flat = numpy.ravel(p)
+    for start in xrange(0, len(flat), block_size):
+        yield start, flat[start:start + block_size]
+
+
+def fdr_histogram(p, pi0=1.0, bins=2**20, block_size=2**20, out=None):
+    check_pi0(pi0)
+
+    # Two passes over blocks of p. The first counts p-values in right-closed
+    # bins of width 1 / bins; the second evaluates pi0 * n * t / #{p <= t}
+    # at the bin edges t >= p only. The q-values are therefore never smaller
+    # than the exact ones and exceed them by at most pi0 * n / (bins * rank).
+    def bin_index(x):
+        return numpy.clip(numpy.ceil(x * bins).astype(int) - 1, 0, bins - 1)
+
+    counts = numpy.zeros(bins, dtype=int)
+    for start, block in blocks(p, block_size):
+        block = block[~numpy.isnan(block)]
+        counts += numpy.bincount(bin_index(block), minlength=bins)
+
+    cumulative = counts.cumsum()
+    edges = numpy.arange(1, bins + 1) / float(bins)
+    with numpy.errstate(divide="ignore"):
+        edge_q = float(pi0) * cumulative[-1] * edges / cumulative
+    edge_q = numpy.minimum(1, cummin(edge_q[::-1])[::-1])
+
+    q = numpy.empty(numpy.size(p)) if out is None else out.reshape(-1)
+    for start, block in blocks(p, block_size):
+        nna = ~numpy.isnan(block)
+        q_block = numpy.repeat(numpy.nan, len(block))
+        q_block[nna] = edge_q[bin_index(block[nna])]
+        q[start:start + len(block)] = q_block
+
+    return q.reshape(numpy.shape(p)) if out is None else out
+
+
+def estimate_pi0(p, lambdas=numpy.arange(0.05, 0.96, 0.05), num_bootstraps=100):
+    p = numpy.ma.getdata(p)[~numpy.ma.getmaskarray(p)]
+    p = numpy.sort(p[~numpy.isnan(p)])
+    n = len(p)
+
+    lambdas = numpy.atleast_1d(lambdas)
+    above = n - numpy.searchsorted(p, lambdas, "right")
+    pi0s = above / (n * (1 - lambdas))
+    if len(lambdas) == 1:
+        return min(1.0, pi0s[0])
 
-    q[nna] = numpy.minimum(1, cummin(float(pi0) * len(p) / i * p[o])[ro])
-    return q
+    # Storey, Taylor and Siegmund (2004): lambda is chosen to minimise the
+    # bootstrap mean squared error. Only the counts between consecutive
+    # lambdas matter, so the resamples are drawn as multinomial counts.
+    between = -numpy.diff(numpy.r_[n, above, 0])
+    resampled = numpy.random.multinomial(n, between / float(n), size=num_bootstraps)
+    resampled_above = resampled[:, :0:-1].cumsum(1)[:, ::-1]
+    bootstrap_pi0s = resampled_above / (n * (1 - lambdas))
 
+    mse = ((bootstrap_pi0s - pi0s.min())**2).mean(0)
+    return min(1.0, pi0s[mse.argmin()])
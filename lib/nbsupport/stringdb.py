@@ -1,17 +1,53 @@
 import csv
 import gzip
+import multiprocessing
+import numpy
+import os
+import pandas
+import scipy.sparse
 import sqlite3
 
+import nbsupport.util
+
 from contextlib import closing
+from itertools import islice
+
 
+BATCH_SIZE = 100000
 
-def create_string_db(db_filename, protein_links_filename, protein_aliases_filename):
+
+def create_string_db(db_filename, protein_links_filename, protein_aliases_filename, batch_size=BATCH_SIZE):
     with closing(sqlite3.connect(db_filename)) as db:
         db.text_factory = str
-    
-        insert_protein_ids(db, protein_links_filename)
-        insert_protein_links(db, protein_links_filename)
-        insert_protein_names(db, protein_aliases_filename)
+        use_bulk_load_pragmas(db)
+
+        insert_protein_links(db, protein_links_filename, batch_size)
+        insert_protein_names(db, protein_aliases_filename, batch_size)
+        create_indexes(db)
+
+
+def use_bulk_load_pragmas(db):
+    # The database is rebuilt from scratch when anything goes wrong, so
+    # neither a rollback journal nor synced writes are needed
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA cache_size = -1048576")
+    db.execute("PRAGMA temp_store = MEMORY")
+
+
+def create_indexes(db):
+    with db:
+        db.execute("CREATE INDEX protein_link_index on protein_links(protein_id_a)")
+        db.execute("CREATE INDEX protein_name_index ON protein_names(protein_name)")
+
+
+def insert_many(db, statement, rows, batch_size):
+    rows = iter(rows)
+    with db:
+        batch = list(islice(rows, batch_size))
+        while batch:
+            db.executemany(statement, batch)
+            batch = list(islice(rows, batch_size))
 
 
 ###
@@ -28,34 +64,6 @@ def create_proteins_table(db):
         """)
 
 
-def insert_protein_ids(db, filename):
-    create_proteins_table(db)
-    
-    with gzip.open(filename) as stream:
-        reader = csv.reader(stream, csv.excel_tab, delimiter=" ")
-
-        header = reader.next()
-        check_protein_links_header(header)
-
-        protein_ids = {}
-        next_protein_id = 0
-        
-        for record in reader:
-            if record[PPI_PROTEIN1_COLUMN].startswith("9606.") and int(record[PPI_SCORE_COLUMN]) > 800:
-                species1, protein1 = record[PPI_PROTEIN1_COLUMN].split(".", 1)
-                species2, protein2 = record[PPI_PROTEIN2_COLUMN].split(".", 1)
-                assert species1 == species2
-
-                for protein in [protein1, protein2]:
-                    if protein not in protein_ids:
-                        protein_ids[protein] = next_protein_id
-                        next_protein_id += 1
-
-        with db:
-            for protein, protein_id in sorted(protein_ids.iteritems(), key=lambda x: x[1]):
-                db.execute("INSERT INTO proteins VALUES (?, ?)", (protein_id, protein))
-
-
 def read_protein_ids(db):
     return dict(db.execute("SELECT protein_id, _id FROM proteins"))
 
@@ -86,34 +94,42 @@ def create_protein_links_table(db):
             combined_score INTEGER)
         """)
 
-    db.execute("CREATE INDEX protein_link_index on protein_links(protein_id_a)")
-
 
-def insert_protein_links(db, filename):
-    create_protein_links_table(db)
-    
+def read_protein_links(filename):
     with gzip.open(filename) as stream:
-        reader = csv.reader(stream, csv.excel_tab, delimiter=" ")
-
-        header = reader.next()
-        check_protein_links_header(header)
-
-        protein_ids = read_protein_ids(db)
-        record_id = 0
-        
-        with db:
-            for record in reader:
-                if record[PPI_PROTEIN1_COLUMN].startswith("9606.") and int(record[PPI_SCORE_COLUMN]) > 800:
+        check_protein_links_header(stream.readline().split())
+
+        for line in stream:
+            # Only human links with a high combined score are kept; the
+            # prefix check skips the other species before any splitting
+            if line.startswith("9606."):
+                record = line.split()
+                score = int(record[PPI_SCORE_COLUMN])
+                if score > 800:
                     species1, protein1 = record[PPI_PROTEIN1_COLUMN].split(".", 1)
                     species2, protein2 = record[PPI_PROTEIN2_COLUMN].split(".", 1)
                     assert species1 == species2
-                    score = int(record[PPI_SCORE_COLUMN])
+                    yield protein1, protein2, score
+
+
+def insert_protein_links(db, filename, batch_size=BATCH_SIZE):
+    create_proteins_table(db)
+    create_protein_links_table(db)
+
+    # Proteins are numbered in order of first appearance while the links
+    # are streamed, so the file is only read once
+    protein_ids = {}
 
-                    db.execute(
-                        "INSERT INTO protein_links VALUES(?, ?, ?, ?)",
-                        (record_id, protein_ids[protein1], protein_ids[protein2], score))
+    def links():
+        for record_id, (protein1, protein2, score) in enumerate(read_protein_links(filename)):
+            id1 = protein_ids.setdefault(protein1, len(protein_ids))
+            id2 = protein_ids.setdefault(protein2, len(protein_ids))
+            yield record_id, id1, id2, score
 
-                    record_id += 1
+    insert_many(db, "INSERT INTO protein_links VALUES(?, ?, ?, ?)", links(), batch_size)
+    insert_many(db, "INSERT INTO proteins VALUES (?, ?)",
+                sorted(((protein_id, protein) for protein, protein_id in protein_ids.iteritems())),
+                batch_size)
 
 
 ####
@@ -140,12 +156,10 @@ def create_names_table(db):
             PRIMARY KEY (protein_id, protein_name, source))
         """)
 
-    db.execute("CREATE INDEX protein_name_index ON protein_names(protein_name)")
 
-
-def insert_protein_names(db, filename):
+def insert_protein_names(db, filename, batch_size=BATCH_SIZE):
     create_names_table(db)
-    
+
     with gzip.open(filename) as stream:
         reader = csv.reader(stream, csv.excel_tab)
 
@@ -153,8 +167,8 @@ def insert_protein_names(db, filename):
         check_names_header(header)
 
         protein_ids = read_protein_ids(db)
-        
-        with db:
+
+        def names():
             for record in reader:
                 if record[NAMES_PROTEIN_COLUMN].startswith("9606."):
                     species, protein = record[NAMES_PROTEIN_COLUMN].split(".", 1)
@@ -164,6 +178,197 @@ def insert_protein_names(db, filename):
                     if protein in protein_ids:
                         for source in sources:
                             if source == "BioMart_HUGO":
-                                db.execute(
-                                    "INSERT INTO protein_names VALUES (?, ?, ?)",
-                                    (protein_ids[protein], alias, source))
+                                yield protein_ids[protein], alias, source
+
+        insert_many(db, "INSERT INTO protein_names VALUES (?, ?, ?)", names(), batch_size)
+
+
+####
+#
+# In-memory interaction index
+#
+# The HUGO-named interaction network is held as a symmetric CSR adjacency
+# over int32 name ids. Within each row the column ids are sorted, so the
+# keys row * n + column of all edges form one sorted array, and edge
+# queries become a single searchsorted.
+#
+
+class StringIndex(object):
+    def __init__(self, indptr, indices, names):
+        self.indptr = indptr
+        self.indices = indices
+        self.names = names
+        self.name_index = pandas.Index(names)
+        self._keys = None
+
+    @classmethod
+    def from_adjacency(cls, adjacency, names):
+        adjacency = scipy.sparse.csr_matrix(adjacency, dtype=bool)
+        adjacency.sum_duplicates()
+        adjacency.eliminate_zeros()
+        adjacency.sort_indices()
+        return cls(adjacency.indptr.astype(numpy.int64), adjacency.indices.astype(numpy.int32), names)
+
+    @classmethod
+    def from_db(cls, db, min_score=800):
+        names = numpy.array(list(db.execute(
+            "SELECT protein_id, protein_name FROM protein_names WHERE source = 'BioMart_HUGO'")), dtype=object)
+        links = numpy.array(list(db.execute(
+            "SELECT protein_id_a, protein_id_b FROM protein_links WHERE combined_score > ?", (min_score,))),
+            dtype=int).reshape(-1, 2)
+
+        protein_ids = names[:, 0].astype(int) if len(names) > 0 else numpy.zeros(0, dtype=int)
+        name_ids, unique_names = pandas.factorize(names[:, 1] if len(names) > 0 else [], sort=True)
+        num_proteins = max(protein_ids.max() if len(protein_ids) > 0 else -1,
+                           links.max() if len(links) > 0 else -1) + 1
+
+        # Joining the links with the names on both sides is a sparse product
+        membership = scipy.sparse.csr_matrix(
+            (numpy.ones(len(protein_ids)), (protein_ids, name_ids)), shape=(num_proteins, len(unique_names)))
+        protein_links = scipy.sparse.csr_matrix(
+            (numpy.ones(len(links)), (links[:, 0], links[:, 1])), shape=(num_proteins, num_proteins))
+        adjacency = membership.T.dot(protein_links).dot(membership)
+
+        return cls.from_adjacency(adjacency + adjacency.T, numpy.asarray(unique_names).astype(str))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        return cls(*[numpy.load(os.path.join(path, "%s.npy" % name), mmap_mode=mmap_mode)
+                     for name in ["indptr", "indices", "names"]])
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name in ["indptr", "indices", "names"]:
+            numpy.save(os.path.join(path, "%s.npy" % name), getattr(self, name))
+
+    @property
+    def num_nodes(self):
+        return len(self.names)
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    @property
+    def adjacency(self):
+        return scipy.sparse.csr_matrix(
+            (numpy.ones(len(self.indices), dtype=bool), self.indices, self.indptr),
+            shape=(self.num_nodes, self.num_nodes))
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            rows = numpy.repeat(numpy.arange(self.num_nodes, dtype=numpy.int64), numpy.diff(self.indptr))
+            self._keys = rows * self.num_nodes + self.indices
+        return self._keys
+
+    def ids(self, names):
+        return self.name_index.get_indexer(numpy.atleast_1d(names))
+
+    def has_edge_ids(self, ids1, ids2):
+        ids1 = numpy.asarray(ids1, dtype=numpy.int64)
+        ids2 = numpy.asarray(ids2, dtype=numpy.int64)
+        known = (ids1 >= 0) & (ids2 >= 0)
+        query = numpy.where(known, ids1 * self.num_nodes + ids2, -1)
+
+        i = numpy.minimum(self.keys.searchsorted(query), len(self.keys) - 1)
+        return known & (len(self.keys) > 0) & (self.keys[i] == query)
+
+    def has_edge(self, names1, names2):
+        result = self.has_edge_ids(self.ids(names1), self.ids(names2))
+        return result if numpy.ndim(names1) > 0 or numpy.ndim(names2) > 0 else result[0]
+
+    def neighbourhood(self, names, k=1):
+        # Boolean frontier expansion, one sparse product per hop
+        ids = self.ids(names)
+        reached = numpy.zeros(self.num_nodes, dtype=bool)
+        reached[ids[ids >= 0]] = True
+        frontier = reached.copy()
+
+        adjacency = self.adjacency
+        for i in xrange(k):
+            frontier = (adjacency.T.dot(frontier) > 0) & ~reached
+            reached |= frontier
+
+        return self.names[reached]
+
+    def neighbours(self, name):
+        i = self.ids(name)[0]
+        if i < 0:
+            return self.names[:0]
+        return self.names[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def reachability(self, k=2):
+        # Pairs connected by a walk of 1 to k edges; for k = 2 this is the
+        # support of A + A^2
+        adjacency = self.adjacency.astype(numpy.int32)
+        reached = adjacency
+        power = adjacency
+        for i in xrange(1, k):
+            power = (power.dot(adjacency) > 0).astype(numpy.int32)
+            reached = reached + power
+
+        return StringIndex.from_adjacency(reached, self.names)
+
+
+####
+#
+# Label-permutation enrichment
+#
+# The genes of a network, e.g. of significant mutual exclusivities, are
+# relabelled at random and the edges that are also STRING interactions are
+# counted. Edges are held as pairs of positions into the gene list and
+# STRING is reduced to its dense adjacency among these genes, so a batch of
+# permutations is a (permutations x genes) position array and each count is
+# one fancy-indexing lookup.
+#
+
+def edge_positions(genes, edges):
+    genes = pandas.Index(genes)
+    edges = numpy.asarray(edges, dtype=object).reshape(-1, 2)
+    positions = numpy.column_stack([genes.get_indexer(edges[:, 0]), genes.get_indexer(edges[:, 1])])
+    if (positions < 0).any():
+        raise ValueError("All edge endpoints must be among the genes")
+
+    # Undirected edges are only counted once, as in a networkx.Graph
+    return numpy.unique(numpy.sort(positions, 1).view([("u", int), ("v", int)])).view(int).reshape(-1, 2)
+
+
+def count_overlaps(induced, positions, permutations, batch_size=1000, seed=None):
+    if seed is not None:
+        numpy.random.seed(seed)
+
+    counts = numpy.empty(permutations, dtype=int)
+    for start in xrange(0, permutations, batch_size):
+        n = min(batch_size, permutations - start)
+        permuted = numpy.random.rand(n, len(induced)).argsort(1)
+        counts[start:start + n] = induced[permuted[:, positions[:, 0]], permuted[:, positions[:, 1]]].sum(1)
+
+    return counts
+
+
+def _count_overlaps_star(args):
+    return count_overlaps(*args)
+
+
+def enrichment_test(index, genes, edges, permutations=10000, batch_size=1000, workers=None):
+    gene_ids = index.ids(genes)
+    induced = index.has_edge_ids(gene_ids[:, numpy.newaxis], gene_ids[numpy.newaxis, :])
+    positions = edge_positions(genes, edges)
+    observed = induced[positions[:, 0], positions[:, 1]].sum()
+
+    if workers is None or workers == 1:
+        null_distribution = count_overlaps(induced, positions, permutations, batch_size)
+    else:
+        worker_permutations = [len(x) for x in numpy.array_split(numpy.arange(permutations), workers)]
+        seeds = nbsupport.util.worker_random_seeds(workers)
+        tasks = [(induced, positions, n, batch_size, seed)
+                 for n, seed in zip(worker_permutations, seeds)]
+
+        with closing(multiprocessing.Pool(workers)) as pool:
+            null_distribution = numpy.concatenate(pool.map(_count_overlaps_star, tasks))
+
+    pvalue = numpy.mean(numpy.append(null_distribution, observed) >= observed)
+    return observed, null_distribution, pvalue
@@ -1,26 +1,69 @@
+import multiprocessing
 import numpy
 import pandas
+import scipy.sparse
+
+import nbsupport.util
+
+from contextlib import closing
 
 
 PANCAN12_STUDIES = ['COAD', 'LUSC', 'READ', 'GBM', 'LAML', 'HNSC',
                     'BLCA', 'UCEC', 'LUAD', 'OV','BRCA', 'KIRC']
 
 
-def read_copynumber_data(stream):
+def read_copynumber_data(stream, samples=None):
     header = stream.readline().rstrip().split("\t")
     assert header[:3] == ["Gene Symbol", "Locus ID", "Cytoband"]
     assert header[3].startswith("TCGA-")
     stream.seek(0)
-    return pandas.read_table(stream, index_col=0, usecols=header[:1] + header[3:])
 
+    # Thresholded copy numbers lie between -2 and 2, so int8 suffices
+    samples = None if samples is None else set(samples)
+    columns = header[3:] if samples is None else [c for c in header[3:] if c in samples]
+    return pandas.read_table(stream, index_col=0, usecols=header[:1] + columns,
+                             dtype={c: numpy.int8 for c in columns})
+
+
+def read_mutation_data_sparse(stream, chunksize=100000):
+    genes = {}
+    barcodes = {}
+    rows = []
+    cols = []
+
+    # Genes and barcodes are numbered in order of appearance, chunk by chunk
+    for chunk in pandas.read_table(stream, index_col=False, chunksize=chunksize,
+                                   usecols=["Tumor_Sample_Barcode", "Hugo_Symbol"]):
+        gene_codes, gene_uniques = pandas.factorize(chunk["Hugo_Symbol"])
+        barcode_codes, barcode_uniques = pandas.factorize(chunk["Tumor_Sample_Barcode"])
 
-def read_mutation_data(stream):
-    maf = pandas.read_table(stream, index_col=False, usecols=["Tumor_Sample_Barcode", "Hugo_Symbol"])
-    return numpy.sign(maf.pivot_table(
-        index=["Hugo_Symbol"],
-        columns=["Tumor_Sample_Barcode"],
-        aggfunc=len,
-        fill_value=0))
+        # Rows with a missing gene or barcode are dropped, as pivot_table did
+        complete = (gene_codes >= 0) & (barcode_codes >= 0)
+        for codes, uniques, ids, out in [(gene_codes, gene_uniques, genes, rows),
+                                         (barcode_codes, barcode_uniques, barcodes, cols)]:
+            used = numpy.unique(codes[complete])
+            lookup = numpy.zeros(len(uniques), dtype=int)
+            lookup[used] = [ids.setdefault(x, len(ids)) for x in uniques[used]]
+            out.append(lookup[codes[complete]])
+
+    rows = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=int)
+    cols = numpy.concatenate(cols) if cols else numpy.zeros(0, dtype=int)
+    matrix = scipy.sparse.coo_matrix(
+        (numpy.ones(len(rows), dtype=numpy.int8), (rows, cols)), shape=(len(genes), len(barcodes))).tocsr()
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+
+    return matrix, sorted(genes, key=genes.get), sorted(barcodes, key=barcodes.get)
+
+
+def read_mutation_data(stream, chunksize=100000):
+    matrix, genes, barcodes = read_mutation_data_sparse(stream, chunksize)
+    gene_order = numpy.argsort(genes)
+    barcode_order = numpy.argsort(barcodes)
+    return pandas.DataFrame(
+        matrix[gene_order][:, barcode_order].toarray().astype(int),
+        index=pandas.Index(numpy.asarray(genes, dtype=object)[gene_order], name="Hugo_Symbol"),
+        columns=pandas.Index(numpy.asarray(barcodes, dtype=object)[barcode_order], name="Tumor_Sample_Barcode"))
 
 
 def read_gistic_output(filename):
@@ -43,3 +86,41 @@ def read_gistic_output(filename):
             line = stream.readline().rstrip("\n").split("\t")
 
     return segments
+
+
+####
+#
+# Pan-cancer ingestion
+#
+
+def normalize_barcodes(barcodes):
+    # The first 15 characters identify participant, sample type and vial
+    return pandas.Index(barcodes).str.slice(0, 15)
+
+
+def read_study(args):
+    filename, study, kind = args
+    return pandas.read_hdf(filename, "/data/{}/{}".format(study, kind))
+
+
+def read_pancan_data(filename, studies=PANCAN12_STUDIES, workers=None):
+    tasks = [(filename, study, kind) for kind in ["mut", "cn"] for study in studies]
+    if workers is None or workers == 1:
+        matrices = map(read_study, tasks)
+    else:
+        with closing(multiprocessing.Pool(workers)) as pool:
+            matrices = pool.map(read_study, tasks)
+
+    mut = pandas.concat(matrices[:len(studies)], 1).fillna(0)
+    cn = pandas.concat(matrices[len(studies):], 1)
+    strata = numpy.repeat(studies, [matrix.shape[1] for matrix in matrices[len(studies):]])
+
+    mut.columns = normalize_barcodes(mut.columns)
+    cn.columns = normalize_barcodes(cn.columns)
+
+    mut_selection, cn_selection = nbsupport.util.aligned_positions(mut.columns, cn.columns)
+    mut = mut.iloc[:, mut_selection]
+    cn = cn.iloc[:, cn_selection]
+    strata = pandas.Series(strata[cn_selection], cn.columns)
+
+    return mut, cn == 2, cn == -2, strata
@@ -1,14 +1,193 @@
-import rpy2.robjects.numpy2ri
-rpy2.robjects.numpy2ri.activate()
+import numpy
+import scipy.optimize
+import scipy.stats
 
-from rpy2 import robjects
-from rpy2.robjects.packages import importr
 
-timex_package = importr("TiMEx")
-__version__ = timex_package.___NAMESPACE___["spec"].rx2("version")[0]
+# The native backend has not been shown to agree with the R package, which
+# produced the published results, so the R package stays the default until
+# check_against_reference passes
+native_version = "Python-based reimplementation (not yet checked against the R package)"
+
+try:
+    import rpy2.robjects.numpy2ri
+    rpy2.robjects.numpy2ri.activate()
+
+    from rpy2 import robjects
+    from rpy2.robjects.packages import importr
+
+    timex_package = importr("TiMEx")
+    r_version = timex_package.___NAMESPACE___["spec"].rx2("version")[0]
+
+except:
+    import warnings
+    warnings.warn("Unable to import the TiMEx R package. Only the native "
+                  "backend is available, which has not yet been checked "
+                  "against the R package.")
+
+    r_version = None
+
+
+# Version of the default backend
+__version__ = r_version
+
+
+def timex_test_r(events, groups):
+    if r_version is None:
+        raise RuntimeError("The TiMEx R package is not available")
 
-def timex_test(events, groups):
     events_r = robjects.Matrix(events.T)
     return [
         timex_package.testCliqueAsGroup(robjects.IntVector(group), events_r).rx2("pvalueLRT")[0]
         for group in groups]
+
+
+def timex_test(events, groups, backend="r"):
+    if backend == "r":
+        return timex_test_r(events, groups)
+    elif backend != "native":
+        raise ValueError("Invalid backend: %s. Legal values are 'native' and 'r'" % backend)
+
+    events = numpy.asarray(events) > 0
+    gene_frequencies = numpy.clip(events.mean(1), 1e-3, 1 - 1e-3)
+    gene_rates = gene_frequencies / (1 - gene_frequencies)
+
+    pvalues = numpy.empty(len(groups))
+    group_sizes = numpy.array([len(group) for group in groups])
+    for k in numpy.unique(group_sizes):
+        selection = numpy.nonzero(group_sizes == k)[0]
+        members = numpy.array([groups[i] for i in selection], dtype=int)
+        pvalues[selection] = timex_clique_pvalues(
+            pattern_counts(events, members), gene_rates[members])
+
+    return pvalues
+
+
+def compare_with_reference(events, groups, atol=1e-3):
+    native = numpy.asarray(timex_test(events, groups, "native"))
+    reference = numpy.asarray(timex_test_r(events, groups))
+    return native, reference, numpy.abs(native - reference) <= atol
+
+
+def check_against_reference(gene_marginals, sample_marginals, num_replicates=1, atol=1e-3):
+    # Same simulation as the group test comparison: independent alterations
+    # with spiked-in mutually exclusive groups and their negative controls
+    import nbsupport.simulations
+
+    for i in xrange(num_replicates):
+        events = nbsupport.simulations.generate_independent_alterations(gene_marginals, sample_marginals)
+        events, pos_groups, neg_groups = nbsupport.simulations.add_mutex_groups(events)
+        groups = numpy.concatenate([neg_groups, pos_groups])
+
+        native, reference, agree = compare_with_reference(events, groups, atol)
+        if not agree.all():
+            raise AssertionError(
+                "Native and R TiMEx p-values differ by more than %g for %d of %d groups "
+                "(largest difference %g)" % (
+                    atol, (~agree).sum(), len(groups), numpy.abs(native - reference).max()))
+
+
+####
+#
+# Native implementation
+#
+# Every gene i is altered after an exponential waiting time with rate
+# lambda_i and a tumour is observed after an exponential time with rate 1.
+# With probability mu, the first alteration in the group prevents all later
+# ones; otherwise the genes are altered independently. The likelihood only
+# depends on the 2^k alteration pattern counts of a group.
+#
+
+def pattern_counts(events, members):
+    k = members.shape[1]
+    codes = (events[members] * (1 << numpy.arange(k))[:, numpy.newaxis]).sum(1)
+    codes += 2**k * numpy.arange(len(members))[:, numpy.newaxis]
+    return numpy.bincount(codes.ravel(), minlength=len(members) * 2**k).reshape(
+        len(members), 2**k).astype(float)
+
+
+def superset_transform(f, k):
+    # Alternating sum over all supersets of each subset, one bit at a time
+    f = f.reshape(f.shape[:1] + (2,) * k).copy()
+    for axis in xrange(1, k + 1):
+        index = [slice(None)] * (k + 1)
+        index[axis] = 0
+        other = list(index)
+        other[axis] = 1
+        f[tuple(index)] -= f[tuple(other)]
+    return f.reshape(f.shape[0], 2**k)
+
+
+def timex_likelihoods(rates, mu, k):
+    bits = (numpy.arange(2**k)[:, numpy.newaxis] >> numpy.arange(k)) & 1
+    full = 2**k - 1
+    patterns = numpy.arange(2**k)
+
+    # independent component
+    denominator = 1 + rates.dot(bits.T)
+    independent = superset_transform(1 / denominator, k)[:, full ^ patterns]
+    d_independent = numpy.array([
+        superset_transform(-bits[:, i] / denominator**2, k)[:, full ^ patterns]
+        for i in xrange(k)])
+
+    # mutually exclusive component
+    total = 1 + rates.sum(1)[:, numpy.newaxis]
+    single = bits.sum(1) == 1
+    exclusive = numpy.zeros_like(independent)
+    exclusive[:, 0] = 1 / total[:, 0]
+    exclusive[:, single] = rates / total
+    d_exclusive = numpy.zeros_like(d_independent)
+    d_exclusive[:, :, 0] = -1 / total[:, 0]**2
+    d_exclusive[:, :, single] = -rates / total**2
+    d_exclusive[:, :, single] += numpy.eye(k)[:, numpy.newaxis, :] / total
+
+    mu = mu[:, numpy.newaxis]
+    likelihood = mu * exclusive + (1 - mu) * independent
+    d_rates = mu * d_exclusive + (1 - mu) * d_independent
+    d_mu = exclusive - independent
+
+    return likelihood, d_rates, d_mu
+
+
+def timex_loglik(params, counts, k, fit_mu):
+    params = params.reshape(len(counts), -1)
+    rates = numpy.exp(params[:, :k])
+    if fit_mu:
+        mu = 1 / (1 + numpy.exp(-params[:, k]))
+    else:
+        mu = numpy.zeros(len(counts))
+
+    likelihood, d_rates, d_mu = timex_likelihoods(rates, mu, k)
+    weights = counts / likelihood
+
+    gradient = [(weights * d_rates).sum(2).T * rates]
+    if fit_mu:
+        gradient.append(((weights * d_mu).sum(1) * mu * (1 - mu))[:, numpy.newaxis])
+
+    loglik = (counts * numpy.log(likelihood)).sum(1)
+    return loglik, numpy.hstack(gradient)
+
+
+def timex_fit(counts, start, k, fit_mu):
+    def objective(params):
+        loglik, gradient = timex_loglik(params, counts, k, fit_mu)
+        return -loglik.sum(), -gradient.ravel()
+
+    # The groups are independent, so the joint objective is separable and
+    # fitting them together is the same as fitting each on its own
+    params = scipy.optimize.minimize(
+        objective, start.ravel(), jac=True, method="L-BFGS-B",
+        bounds=[(-30, 30)] * start.size,
+        options=dict(maxiter=10000, ftol=1e-14, gtol=1e-8)).x
+
+    return params.reshape(start.shape), timex_loglik(params, counts, k, fit_mu)[0]
+
+
+def timex_clique_pvalues(counts, rates, mu_start=0.1):
+    k = rates.shape[1]
+
+    params0, loglik0 = timex_fit(counts, numpy.log(rates), k, False)
+    start = numpy.column_stack([params0, numpy.repeat(numpy.log(mu_start / (1 - mu_start)), len(counts))])
+    params1, loglik1 = timex_fit(counts, start, k, True)
+
+    statistic = numpy.maximum(0, 2 * (loglik1 - loglik0))
+    return scipy.stats.chi2.sf(statistic, 1)
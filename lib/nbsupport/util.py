@@ -12,25 +12,36 @@ def set_random_seed():
     numpy.random.seed(NUMPY_RANDOM_SEED)
 
 
+def derived_random_seeds(n):
+    return numpy.random.RandomState(NUMPY_RANDOM_SEED).randint(
+        numpy.iinfo(numpy.int32).max, size=n)
+
+
+def worker_random_seeds(n):
+    # Drawn from the global state, so that they are reproducible after
+    # set_random_seed() and differ between consecutive calls
+    return numpy.random.randint(numpy.iinfo(numpy.int32).max, size=n)
+
+
+def aligned_positions(*labels):
+    # Labels shared by all arrays are matched in sorted order; repeated
+    # labels are paired occurrence by occurrence
+    labels = [numpy.asarray(x) for x in labels]
+    orders = [numpy.argsort(x, kind="mergesort") for x in labels]
+    common = reduce(numpy.intersect1d, labels)
+
+    bounds = [(numpy.searchsorted(x[order], common, "left"), numpy.searchsorted(x[order], common, "right"))
+              for x, order in zip(labels, orders)]
+    counts = numpy.min([right - left for left, right in bounds], 0)
+    occurrence = numpy.arange(counts.sum()) - numpy.repeat(counts.cumsum() - counts, counts)
+
+    return [order[numpy.repeat(left, counts) + occurrence] for order, (left, right) in zip(orders, bounds)]
+
+
 def align_columns(*dataframes):
-    def alignment_helper(args):
-        orders = map(numpy.argsort, args)
-        indexes = numpy.zeros(len(args), dtype=int)
-
-        while all(i < len(x) for i, x in zip(indexes, args)):
-            if all(args[i - 1][orders[i - 1][indexes[i - 1]]] == args[i][orders[i][indexes[i]]]
-                   for i in xrange(1, len(args))):
-                yield [orders[i][indexes[i]] for i in xrange(len(args))]
-                indexes += 1
-            else:
-                values = numpy.array([args[i][orders[i][indexes[i]]]
-                                      for i in xrange(len(args))])
-                indexes[values < max(values)] += 1
-
-    column_labels = [df.columns for df in dataframes]
-    return tuple(dataframes[i].iloc[:, selection]
-                 for i, selection
-                 in enumerate(zip(*alignment_helper(column_labels))))
+    return tuple(df.iloc[:, selection]
+                 for df, selection
+                 in zip(dataframes, aligned_positions(*[df.columns for df in dataframes])))
 
 
 def check_digest(filename, md5sum, buffer_size = 1024**2):